@@ -0,0 +1,60 @@
+"""Compare lines/sec of the default loop and the compiled loop (--compile).
+
+    $ python benchmarks/bench_loop.py [LINES]
+"""
+
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tse.main
+
+ACTIONS = [
+    ['-s', '', 'P(L)'],
+    ['-s', '', 'P(L1, N)'],
+    ['-b', 'n=0', '-s', 'ERROR', 'n+=1', '-s', '(\\d+)', 'n+=int(S1)'],
+    ['-b', 'n=0'] + [a for i in range(30) for a in ('-s', 'WORD%d' % i, 'n+=1')],
+]
+
+
+def bench(args, filename, compile_loop):
+    parser = tse.main.getargparser()
+    args = parser.parse_args(args + ['--', filename])
+    env = tse.main.Env(
+        args.execute, args.statement, args.begin, args.end, args.input_encoding,
+        args.output_encoding, args.module, args.module_star, args.script_file,
+        args.inplace, args.ignore_case, args.field_separator, args.FILE,
+        compile_loop=compile_loop)
+
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        start = time.perf_counter()
+        tse.main.run(env)
+        return time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+
+
+def main():
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    fd, filename = tempfile.mkstemp()
+    try:
+        with io.open(fd, 'w') as f:
+            for i in range(nlines):
+                f.write(u'%d abc def ghi %s jkl\n' % (i, 'ERROR' if i % 10 == 0 else 'INFO'))
+
+        for args in ACTIONS:
+            default = bench(args, filename, False)
+            compiled = bench(args, filename, True)
+            print('%-60s %10.0f %10.0f lines/sec (x%.2f)' % (
+                ' '.join(args), nlines / default, nlines / compiled, default / compiled))
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
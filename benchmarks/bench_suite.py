@@ -0,0 +1,206 @@
+"""Benchmarks of the main paths of tse.
+
+Synthetic corpora are generated with a fixed seed, and each case is run
+in-process with output written to /dev/null. The best of ``--repeat``
+runs is reported in lines/sec and MB/sec.
+
+    $ python benchmarks/bench_suite.py --output baseline.json
+    $ python benchmarks/bench_suite.py --compare baseline.json
+
+With ``--compare``, cases slower than the baseline by more than
+``--threshold`` percent are reported as regressions and the exit status
+is 1.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tse.main
+
+ASCII_WORDS = ['abc', 'def', 'ghi', 'jkl', 'mno', 'pqr', 'stu', 'vwx', 'yz',
+               'alpha', 'beta', 'gamma', 'delta', 'request', 'response', 'user']
+MULTIBYTE_WORDS = [u'あいう', u'日本語', u'文字列',
+                   u'テスト', u'処理', u'入力', u'出力']
+
+# name: (words, words per line, ratio of lines containing "ERROR", encoding)
+CORPORA = {
+    'short-ascii': (ASCII_WORDS, 4, 0.01, 'utf-8'),
+    'short-ascii-dense': (ASCII_WORDS, 4, 0.5, 'utf-8'),
+    'long-ascii': (ASCII_WORDS, 50, 0.01, 'utf-8'),
+    'short-multibyte': (MULTIBYTE_WORDS, 4, 0.01, 'utf-8'),
+    'long-multibyte': (MULTIBYTE_WORDS, 50, 0.01, 'utf-8'),
+    'short-multibyte-sjis': (MULTIBYTE_WORDS, 4, 0.01, 'shift_jis'),
+    'short-ascii-rare': (ASCII_WORDS, 4, 0.001, 'utf-8'),
+}
+
+# (name, corpus, arguments)
+CASES = [
+    ('print', 'short-ascii', ['-s', '', 'P(L)']),
+    ('print-long', 'long-ascii', ['-s', '', 'P(L)']),
+    ('print-multibyte', 'short-multibyte', ['-s', '', 'P(L)']),
+    ('print-long-multibyte', 'long-multibyte', ['-s', '', 'P(L)']),
+    ('print-compile', 'short-ascii', ['--compile', '-s', '', 'P(L)']),
+    ('print-bytes', 'short-ascii', ['--bytes', '-s', '', 'P(L)']),
+    ('search-sparse', 'short-ascii', ['-s', 'ERROR', 'P(L)']),
+    ('search-dense', 'short-ascii-dense', ['-s', 'ERROR', 'P(L)']),
+    ('search-first', 'long-ascii', ['--max-count', '1', '-s', 'ERROR', 'P(L)']),
+    ('search-sparse-scan', 'long-ascii', ['--scan', '-s', 'ERROR', 'P(L)']),
+    ('fields', 'short-ascii', ['-s', '', 'P(L1, L3, N)']),
+    ('fields-long', 'long-ascii', ['-s', '', 'P(L1, L30)']),
+    ('fields-separator', 'short-ascii', ['-F', '[ ,]+', '-s', '', 'P(L1, L3)']),
+    ('fields-literal', 'short-ascii', ['-F', ' ', '-s', '', 'P(L1, L3)']),
+    ('fields-csv', 'short-ascii', ['--csv', '-s', '', 'P(L1)']),
+    ('fields-widths', 'short-ascii', ['--widths', '2,3,4', '-s', '', 'P(L1, L3)']),
+    ('records-literal', 'short-ascii', ['--rs', ' ', '-s', '', 'P(L)']),
+    ('records-regex', 'short-ascii', ['--rs', r'\s+', '-s', '', 'P(L)']),
+    ('sum', 'short-ascii', ['-b', 'n=0', '-s', '', 'n+=int(L1)']),
+    ('sum-batch', 'short-ascii', ['--batch', '1000', '-b', 'n=0', '-s', '',
+                                  'n+=sum(map(int, FIELDS[1]))']),
+    ('aggregate-dict', 'short-ascii', ['-b', 'd={}', '-s', '', 'd[L4]=d.get(L4,0)+1']),
+    ('aggregate-count', 'short-ascii', ['-b', 'c=Count()', '-s', '', 'c.add(L4)']),
+    ('aggregate-topk', 'short-ascii', ['-b', 'c=TopK(10)', '-s', '', 'c.add(L4)']),
+    ('aggregate-quantiles', 'short-ascii', ['-b', 'q=Quantiles()', '-s', '', 'q.add(int(L1))']),
+    ('aggregate-distinct', 'short-ascii', ['-b', 'd=Distinct()', '-s', '', 'd.add(L)']),
+    ('sort', 'short-ascii', ['--sort', '-s', '', 'P(L)']),
+    ('sort-spill', 'short-ascii', ['--sort', '--sort-memory', '1M', '-s', '', 'P(L)']),
+    ('uniq-count', 'short-ascii', ['--uniq-count', '-s', '', 'P(L4)']),
+    ('statements-30', 'short-ascii',
+     ['-b', 'n=0'] + [a for i in range(30) for a in ('-s', 'WORD%d' % i, 'n+=1')]),
+    ('named-groups', 'short-ascii-dense',
+     ['-s', r'(?P<level>ERROR|INFO) (?P<word>\w+)', 'P(level, word)']),
+    ('inplace', 'short-ascii', ['-s', 'ERROR', 'P("error")', '-s', '', 'P(L)',
+                                '--inplace', '.bak']),
+    ('encoding-sjis', 'short-multibyte-sjis', ['-ie', 'shift_jis', '-s', '', 'P(L)']),
+    ('command', 'short-ascii-rare', ['-s', 'ERROR', 'P(`echo abc`, E("echo def"))']),
+]
+
+
+def make_corpus(filename, name, nlines):
+    words, nwords, ratio, encoding = CORPORA[name]
+    rand = random.Random(name)
+    with io.open(filename, 'w', encoding=encoding) as f:
+        for i in range(nlines):
+            level = 'ERROR' if rand.random() < ratio else 'INFO'
+            f.write(u'%d %s %s\n' % (i, level, u' '.join(
+                rand.choice(words) for n in range(nwords))))
+
+
+def run_case(args, filename):
+    if '--inplace' in args:
+        target = filename + '.inplace'
+        shutil.copyfile(filename, target)
+    else:
+        target = filename
+
+    stdout = sys.stdout
+    sys.stdout = io.open(os.devnull, 'w')
+    try:
+        start = time.perf_counter()
+        tse.main.main(['--no-cache'] + args + ['--', target])
+        return time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        if target != filename:
+            for f in (target, target + '.bak'):
+                if os.path.exists(f):
+                    os.unlink(f)
+
+
+def run(options):
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        corpora = {}
+        for name, corpus, args in CASES:
+            if options.case and not any(k in name for k in options.case):
+                continue
+            if corpus not in corpora:
+                corpora[corpus] = os.path.join(tmpdir, corpus)
+                make_corpus(corpora[corpus], corpus, options.lines)
+
+            filename = corpora[corpus]
+            size = os.path.getsize(filename)
+            seconds = min(run_case(args, filename) for i in range(options.repeat))
+            results[name] = {
+                'args': args,
+                'corpus': corpus,
+                'seconds': seconds,
+                'lines_per_sec': options.lines / seconds,
+                'mb_per_sec': size / seconds / 1024 / 1024,
+            }
+            print('%-22s %-22s %12.0f lines/sec %8.2f MB/sec' % (
+                name, corpus, results[name]['lines_per_sec'], results[name]['mb_per_sec']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return {
+        'python': sys.version,
+        'platform': platform.platform(),
+        'tse': tse.main.VERSION,
+        'lines': options.lines,
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Prints ratios of current results to the baseline and returns names of
+    regressed cases."""
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if not base:
+            print('%-22s %12s' % (name, 'new'))
+            continue
+        ratio = result['lines_per_sec'] / base['lines_per_sec']
+        mark = ''
+        if ratio < 1 - threshold / 100.0:
+            mark = 'REGRESSION'
+            regressions.append(name)
+        print('%-22s %12.0f -> %12.0f lines/sec (x%.2f) %s' % (
+            name, base['lines_per_sec'], result['lines_per_sec'], ratio, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks of tse')
+    parser.add_argument('--lines', type=int, default=100000,
+                        help='number of lines of each corpus (default: 100000).')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each case (default: 3).')
+    parser.add_argument('--case', '-k', action='append',
+                        help='run cases whose name contains CASE.')
+    parser.add_argument('--output', '-o', help='write results to OUTPUT as JSON.')
+    parser.add_argument('--compare', '-c', metavar='BASELINE',
+                        help='compare results with BASELINE written by --output.')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='with --compare, percentage of slowdown reported as '
+                             'regression (default: 10).')
+    options = parser.parse_args()
+
+    current = run(options)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('lines') != current['lines']:
+            print('warning: baseline was run with %s lines' % baseline.get('lines'))
+        print()
+        if compare(baseline, current, options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,12 +24,12 @@ setup(
     ],
     packages=['tse'],
     entry_points={
-        'console_scripts': ['tse = tse.main:main']
+        'console_scripts': ['tse = tse.main:main', 'tsec = tse.client:main']
     },
     install_requires=["six"],
     test_suite="tests",
     project_urls={
         'Source': 'https://github.com/atsuoishimoto/tse',
     },
-    python_requires='>=3.4',
+    python_requires='>=3.6',
 )
@@ -7,8 +7,18 @@ import tempfile
 import os
 import sys
 import fileinput
+import re
+import json
+import pickle
+import shutil
+import socket
+import subprocess
+import time
+import random
 from six import StringIO
+import tse
 import tse.main
+import tse.client
 
 
 class _TestBase(unittest.TestCase):
@@ -44,7 +54,19 @@ class _TestBase(unittest.TestCase):
         env = tse.main.Env(args.execute, args.statement, args.begin, args.end,
                            args.input_encoding, args.output_encoding, args.module,
                            args.module_star, args.script_file, args.inplace, args.ignore_case,
-                           args.field_separator, [self.testfilename])
+                           args.field_separator, [self.testfilename],
+                           compile_loop=args.compile_loop, bytes_mode=args.bytes_mode,
+                           scan=args.scan, verbose=args.verbose,
+                           startup_profile=args.startup_profile, stats=args.stats,
+                           profile=args.profile, command_jobs=args.command_jobs,
+                           command_timeout=args.command_timeout,
+                           command_cache=args.command_cache,
+                           field_format=args.field_format, widths=args.widths,
+                           record_separator=args.record_separator,
+                           max_count=args.max_count,
+                           max_count_per_file=args.max_count_per_file,
+                           batch=args.batch, sort_key=args.sort_key, uniq=args.uniq,
+                           uniq_count=args.uniq_count, sort_memory=args.sort_memory)
 
         return tse.main.run(env)
 
@@ -188,6 +210,38 @@ class TestInplace(_TestBase):
                              u"\N{HIRAGANA LETTER A}".encode('utf-8'))
         os.unlink(self.testfilename + '.bak')
 
+    def testUnchanged(self):
+        fd, self.testfilename = tempfile.mkstemp()
+        with io.open(fd, 'w') as f:
+            f.write(u"abc\n")
+        os.utime(self.testfilename, (0, 0))
+
+        args = self._getParser().parse_args(["-s", "", "", "--inplace", ".bak"])
+        env = tse.main.Env(args.execute, args.statement, args.begin, args.end,
+                           args.input_encoding, args.output_encoding, args.module,
+                           args.module_star, args.script_file, args.inplace, args.ignore_case,
+                           args.field_separator, [self.testfilename])
+        tse.main.run(env)
+        self.assertEqual(os.stat(self.testfilename).st_mtime, 0)
+        self.assertFalse(os.path.exists(self.testfilename + '.bak'))
+
+    def testError(self):
+        self.assertRaises(ZeroDivisionError, self._run,
+                          ["-s", "", "1/0", "--inplace", ".bak"], u"abc\n")
+        self.assertEqual(os.listdir(os.path.dirname(self.testfilename)).count(
+            os.path.basename(self.testfilename) + '.bak.%d' % os.getpid()), 0)
+        self.assertFalse(os.path.exists(self.testfilename + '.bak'))
+
+    def testReport(self):
+        sys.stderr = err = StringIO()
+        try:
+            self._run(["-s", "", "P(1)", "-v", "--inplace", ".bak"], u"abc\n")
+        finally:
+            sys.stderr = sys.__stderr__
+        os.unlink(self.testfilename + '.bak')
+        self.assertEqual(err.getvalue(),
+                         u"tse: 1 file(s) changed, 0 file(s) unchanged, 2 byte(s) written\n")
+
 
 class TestSeparator(_TestBase):
 
@@ -201,6 +255,1260 @@ class TestSeparator(_TestBase):
         self.assertEqual(globals['a'], [u"A", u"B", u"C", u"D", u"E", u"F"])
 
 
+class TestBindings(_TestBase):
+
+    def testUnused(self):
+        globals = self._run(["-s", "(a)(b)", "a=L"], u"abc def\n")
+        self.assertEqual(globals['a'], u"abc def")
+        self.assertNotIn('L1', globals)
+        self.assertNotIn('S2', globals)
+        self.assertNotIn('F', globals)
+
+    def testEnd(self):
+        globals = self._run(["-s", ".*", "pass", "-e", "a=(L1, N, S0)"],
+                            u"abc def\nghi jkl mno\n")
+        self.assertEqual(globals['a'], (u"ghi", 3, u"ghi jkl mno"))
+
+    def testFunction(self):
+        globals = self._run(["-b", "lines=[]", "def f():{{lines.append(L2)}}",
+                             "-s", ".*", "f()"], u"abc def\nghi jkl\n")
+        self.assertEqual(globals['lines'], [u"def", u"jkl"])
+
+    def testGroup(self):
+        globals = self._run(["-s", "(?P<x>\\w+) (\\w+)", "a=(x, S2)"],
+                            u"abc def\n")
+        self.assertEqual(globals['a'], (u"abc", u"def"))
+
+    def testLazy(self):
+        globals = self._run(
+            ["-s", "(\\w+)", "a=eval('L2'); b=locals()['S1']; L1='x'; c=eval('L1')"],
+            u"abc def\n")
+        self.assertEqual(globals['a'], u"def")
+        self.assertEqual(globals['b'], u"abc")
+        self.assertEqual(globals['c'], u"x")
+        self.assertNotIn('L2', globals)
+
+
+class TestCompile(_TestBase):
+
+    def testStatements(self):
+        sys.stdout = out = StringIO()
+        globals = self._run(
+            ["--compile", "-b", "n=0", "-s", "^#", "pass",
+             "-s", "(?P<w>\\w+) (\\w+)", "n+=1; print(w, S2, L1, N, LINENO)",
+             "-s", "", "", "-e", "a=L"],
+            u"# abc\nabc def\n-\n")
+        self.assertEqual(out.getvalue(), u"abc def abc 2 2\n-\n")
+        self.assertEqual(globals['n'], 1)
+        self.assertEqual(globals['a'], u"-")
+        self.assertNotIn('L1', globals)
+
+    def testFunction(self):
+        globals = self._run(["--compile", "-b", "lines=[]", "def f():{{lines.append(L2)}}",
+                             "-s", ".*", "f()"], u"abc def\nghi jkl\n")
+        self.assertEqual(globals['lines'], [u"def", u"jkl"])
+
+    def testFallback(self):
+        globals = self._run(["--compile", "-s", "\\w+", "a=eval('L')"], u"abc\n")
+        self.assertEqual(globals['a'], u"abc")
+
+    def testCommand(self):
+        sys.stdout = out = StringIO()
+        self._run(["--compile", "-s", ".*", 'print(f`echo {L}`)'], u"abcdefg")
+        self.assertEqual(out.getvalue(), 'abcdefg\n\n')
+
+
+class TestDispatch(_TestBase):
+
+    def testOrder(self):
+        for opt in [[], ["--compile"]]:
+            globals = self._run(opt + [
+                "-b", "lines=[]", "-s", "a", "lines.append((0, S0, M.start()))",
+                "-s", "(b)", "lines.append((1, S1))", "-s", "^x", "lines.append((2, L))"],
+                u"xb a\nxb\nxy\nzzz\n")
+            self.assertEqual(globals['lines'],
+                             [(0, u"a", 3), (1, u"b"), (2, u"xy")])
+
+    def testBackref(self):
+        env = tse.main.Env(None, [('statement', ['(a)\\1']), ('statement', ['b'])],
+                           None, None, None, None, None, None, None, None, False, None, [])
+        self.assertIsNone(env.dispatch)
+
+        globals = self._run(
+            ["-b", "lines=[]", "-s", "(a)\\1", "lines.append(0)", "-s", "a", "lines.append(1)"],
+            u"aa\na\n")
+        self.assertEqual(globals['lines'], [0, 1])
+
+    def testDispatch(self):
+        env = tse.main.Env(None, [('statement', ['a']), ('statement', ['(?P<x>b)'])],
+                           None, None, None, None, None, None, None, None, True, None, [])
+        i, m = env.dispatch(u"xB")
+        self.assertEqual((i, m.group('x')), (1, u"B"))
+        self.assertIsNone(env.dispatch(u"xyz"))
+
+
+class TestJobs(_TestBase):
+
+    def setUp(self):
+        super(TestJobs, self).setUp()
+        self.filenames = []
+        for i in range(3):
+            fd, filename = tempfile.mkstemp()
+            with io.open(fd, 'w') as f:
+                f.write(u"".join(u"%d %d\n" % (i, n) for n in range(100)))
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        super(TestJobs, self).tearDown()
+        for filename in self.filenames:
+            for f in (filename, filename + '.bak'):
+                if os.path.exists(f):
+                    os.unlink(f)
+
+    def _runJobs(self, args):
+        args = self._getParser().parse_args(args + ['--'] + self.filenames)
+        env = tse.main.Env(args.execute, args.statement, args.begin, args.end,
+                           args.input_encoding, args.output_encoding, args.module,
+                           args.module_star, args.script_file, args.inplace, args.ignore_case,
+                           args.field_separator, args.FILE, jobs=args.jobs,
+                           unordered=args.unordered, chunk_size=args.chunk_size)
+        return tse.main.run(env)
+
+    def testOutput(self):
+        sys.stdout = out = StringIO()
+        self._runJobs(["-j", "2", "-s", "0$", "P(L)"])
+        self.assertEqual(out.getvalue(),
+                         u"".join(u"%d %d\n" % (i, n) for i in range(3)
+                                  for n in range(0, 100, 10)))
+
+    def testMerge(self):
+        globals = self._runJobs(
+            ["-j", "2", "--unordered", "-b", "n=0", "d={}", "lines=set()",
+             "-s", "", "n+=1; d[L1]=d.get(L1, 0)+1; lines.add(L2)"])
+        self.assertEqual(globals['n'], 300)
+        self.assertEqual(globals['d'], {u"0": 100, u"1": 100, u"2": 100})
+        self.assertEqual(globals['lines'], set(str(n) for n in range(100)))
+        self.assertEqual(len(globals['RESULTS']), 3)
+
+    def testInplace(self):
+        self._runJobs(["-j", "2", "-s", "", "P(L2)", "--inplace", ".bak"])
+        for filename in self.filenames:
+            with io.open(filename) as f:
+                self.assertEqual(f.read(), u"".join(u"%d\n" % n for n in range(100)))
+            self.assertTrue(os.path.exists(filename + '.bak'))
+
+    def testChunk(self):
+        for opt in [[], ["--compile"]]:
+            sys.stdout = out = StringIO()
+            globals = self._runJobs(opt + ["-j", "2", "--chunk-size", "100", "-b", "n=0",
+                                           "-s", "", "n+=1; P(FILENAME, LINENO, L)"])
+            self.assertEqual(out.getvalue(), u"".join(
+                u"%s %d %d %d\n" % (f, n + 1, i, n)
+                for i, f in enumerate(self.filenames) for n in range(100)))
+            self.assertEqual(globals['n'], 300)
+            self.assertGreater(len(globals['RESULTS']), 3)
+
+    def testSize(self):
+        args = self._getParser().parse_args(["--chunk-size", "64M"])
+        self.assertEqual(args.chunk_size, 64 * 1024 * 1024)
+        self.assertRaises(SystemExit, self._getParser().parse_args,
+                          ["--chunk-size", "64X"])
+
+    def testPickle(self):
+        env = tse.main.Env(None, [('statement', ['a', 'P(L)'])], [['n=0']], None,
+                           None, None, None, None, None, None, False, None, [], jobs=2)
+        env = pickle.loads(pickle.dumps(env))
+        self.assertEqual(env.jobs, 2)
+        self.assertEqual(env.begin_names, ['n'])
+        self.assertEqual(len(env.actions), 1)
+
+    def testMergeValues(self):
+        self.assertEqual(tse.main.merge({'a': 1, 'b': [1]}, {'a': 2, 'b': [2], 'c': 3}),
+                         {'a': 3, 'b': [1, 2], 'c': 3})
+        self.assertEqual(tse.main.merge(u"a", u"b"), u"b")
+
+
+class TestBytes(_TestBase):
+
+    def testBytes(self):
+        for opt in [[], ["--compile"]]:
+            globals = self._run(
+                opt + ["--bytes", "-b", "lines=[]", "-s", "(b+) ", "lines.append((L, S1, L2, N))",
+                       "-s", "x", "lines.append(L)", "-F", ","],
+                u"\N{HIRAGANA LETTER A}bb ,c\nx\r\n", enc='utf-8')
+            self.assertEqual(globals['lines'], [
+                (u"\N{HIRAGANA LETTER A}bb ,c".encode('utf-8'), b"bb", b"c", 2),
+                b"x\r"])
+
+    def testOutput(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with io.open(filename, 'w', encoding='utf-8') as f:
+                sys.stdout = f
+                self._run(["--bytes", "-s", "", "P(L, 1, sep=b':')", "print('x')", "-s", "", ""],
+                          u"a\xff\n")
+            with io.open(filename, 'rb') as f:
+                self.assertEqual(f.read(), u"a\xff:1\nx\n".encode('utf-8'))
+        finally:
+            os.unlink(filename)
+
+
+class TestScan(_TestBase):
+
+    def setUp(self):
+        super(TestScan, self).setUp()
+        self.buffer_size = tse.main.BUFFER_SIZE
+        tse.main.BUFFER_SIZE = 7
+
+    def tearDown(self):
+        super(TestScan, self).tearDown()
+        tse.main.BUFFER_SIZE = self.buffer_size
+
+    def testScan(self):
+        input = u"".join(u"%d abc\n" % i for i in range(30)) + u"end"
+        expected = [(n + 1, u"2") if str(n).startswith("2") else (n + 1, 2)
+                    for n in range(30)] + [u"end"]
+        for opt in [[], ["--compile"]]:
+            globals = self._run(
+                ["--scan", "-b", "lines=[]", "-s", "^2", "lines.append((LINENO, S0))",
+                 "-s", "c$", "lines.append((LINENO, N))", "-s", "nd", "lines.append(L)"]
+                + opt, input)
+            self.assertEqual(globals['lines'], expected)
+
+    def testBytes(self):
+        globals = self._run(["--scan", "--bytes", "-b", "lines=[]", "-s", "^1", "lines.append(L)"],
+                            u"1\n2\n\n10")
+        self.assertEqual(globals['lines'], [b"1", b"10"])
+
+    def testEmpty(self):
+        globals = self._run(["--scan", "-b", "n=0", "-s", "", "n+=1"], u"a\n\nb\n")
+        self.assertEqual(globals['n'], 3)
+
+        # Patterns which match the empty string at the end of input without
+        # a trailing newline.
+        for pattern in [u"", u"^", u"$", u"x?", u"b$"]:
+            globals = self._run(["--scan", "-b", "l=[]", "-s", pattern, "l.append((LINENO, L))"],
+                                u"a\nb")
+            expected = [(2, u"b")] if pattern == u"b$" else [(1, u"a"), (2, u"b")]
+            self.assertEqual(globals['l'], expected, pattern)
+
+    def testLineSafe(self):
+        for pattern, safe in [(u"^a$", True), (u"(?s:.)", False), (u"a\\sb", False),
+                              (u"[^a]", False), (u"\\w\\S+\\b", True), (u"(?<=a)b", False),
+                              (u"a\\Z", False), (u"a(?=b)", True), (u"a|\\n", False)]:
+            self.assertEqual(tse.main._line_safe(re.compile(pattern)), safe, pattern)
+
+    def testFallback(self):
+        globals = self._run(["--scan", "-b", "lines=[]", "-s", "a\\s", "lines.append(LINENO)"],
+                            u"a\na b\n")
+        self.assertEqual(globals['lines'], [2])
+
+
+class TestOutputWriter(_TestBase):
+
+    def _env(self, **kwargs):
+        return tse.main.Env(None, None, None, None, None, 'utf-8', None, None, None, None,
+                            False, None, [], **kwargs)
+
+    def testWrite(self):
+        fd, self.testfilename = tempfile.mkstemp()
+        os.close(fd)
+        for kwargs in [{}, {'buffer_size': 3}]:
+            out = self._env(bytes_mode=True, **kwargs).open_output(self.testfilename)
+            for i in range(1000):
+                out.write(u"\N{HIRAGANA LETTER A}%d\n" % i)
+                out.buffer.write(b"b\n")
+            out.close()
+            with io.open(self.testfilename, 'rb') as f:
+                self.assertEqual(f.read(), b"".join(
+                    (u"\N{HIRAGANA LETTER A}%d\n" % i).encode('utf-8') + b"b\n"
+                    for i in range(1000)))
+
+    def testLineBuffered(self):
+        fd, self.testfilename = tempfile.mkstemp()
+        os.close(fd)
+        out = self._env(line_buffered=True).open_output(self.testfilename)
+        try:
+            out.write(u"abc\n")
+            with io.open(self.testfilename, 'rb') as f:
+                self.assertEqual(f.read(), b"abc\n")
+        finally:
+            out.close()
+
+    def testError(self):
+        class Raw(io.RawIOBase):
+            def writable(self):
+                return True
+
+            def write(self, b):
+                raise IOError("error")
+
+        writer = tse.main.AsyncWriter(Raw())
+        writer.write(b"abc")
+        self.assertRaises(IOError, writer.flush)
+        writer.close()
+
+
+class TestCompressed(_TestBase):
+
+    def _runCompressed(self, args, input, module, suffix):
+        import importlib
+        fd, self.testfilename = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        with importlib.import_module(module).open(self.testfilename, 'wb') as f:
+            f.write(input.encode('utf-8'))
+
+        args = self._getParser().parse_args(args)
+        env = tse.main.Env(args.execute, args.statement, args.begin, args.end,
+                           args.input_encoding, args.output_encoding, args.module,
+                           args.module_star, args.script_file, args.inplace, args.ignore_case,
+                           args.field_separator, [self.testfilename], scan=args.scan)
+        return tse.main.run(env)
+
+    def testCompressed(self):
+        input = u"".join(u"%d \N{HIRAGANA LETTER A}\n" % i for i in range(1000))
+        for module, suffix in [('gzip', '.gz'), ('bz2', '.bz2'), ('lzma', '.xz'),
+                               ('gzip', '.dat')]:
+            for opt in [[], ["--scan"]]:
+                globals = self._runCompressed(
+                    ["-b", "lines=[]", "-s", "^99", "lines.append((LINENO, L, FILENAME))"] + opt,
+                    input, module, suffix)
+                self.assertEqual(globals['lines'], [
+                    (n + 1, u"%d \N{HIRAGANA LETTER A}" % n, self.testfilename)
+                    for n in [99] + list(range(990, 1000))])
+                os.unlink(self.testfilename)
+        self.testfilename = None
+
+    def testInplace(self):
+        self.assertRaises(ValueError, self._runCompressed,
+                          ["-s", "", "", "--inplace", ".bak"], u"abc", 'gzip', '.gz')
+
+    def testFifo(self):
+        # Pipes are not sniffed for magic numbers, which would consume input.
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(tmpdir, 'fifo')
+            os.mkfifo(fifo)
+            environ = dict(os.environ)
+            environ['PYTHONPATH'] = os.path.dirname(os.path.dirname(tse.main.__file__))
+            p = subprocess.Popen(
+                [sys.executable, '-m', 'tse.main', '--no-cache', '-s', '', 'P(L)', '--', fifo],
+                env=environ, stdout=subprocess.PIPE)
+            with open(fifo, 'wb') as f:
+                f.write(b"a\nb\n")
+            out, err = p.communicate(timeout=10)
+            self.assertEqual(out, b"a\nb\n")
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testReadAhead(self):
+        reader = tse.main.ReadAheadReader(io.StringIO(u"a\nbc\n\nd"), block_size=2)
+        self.assertEqual(reader.readline(), u"a\n")
+        self.assertEqual(list(reader), [u"bc", u"", u"d"])
+        reader.close()
+
+
+class TestCache(_TestBase):
+
+    def setUp(self):
+        super(TestCache, self).setUp()
+        self.cachedir = tempfile.mkdtemp()
+        self.orgcachedir, tse.main.CACHEDIR = tse.main.CACHEDIR, self.cachedir
+
+    def tearDown(self):
+        tse.main.CACHEDIR = self.orgcachedir
+        shutil.rmtree(self.cachedir)
+        super(TestCache, self).tearDown()
+
+    def _env(self, args, script_file=None):
+        args = self._getParser().parse_args(args)
+        return tse.main.Env(args.execute, args.statement, args.begin, args.end,
+                            args.input_encoding, args.output_encoding, args.module,
+                            args.module_star, script_file, args.inplace, args.ignore_case,
+                            args.field_separator, [], cache=args.cache)
+
+    def testCache(self):
+        args = ["-s", "a", "if L1:{{y=1}}", "-b", "y=0", "-e", "print(y)"]
+        env = self._env(args)
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+        env2 = self._env(args)
+        self.assertEqual(env2.compiled, env.compiled)
+        self.assertEqual(env2.action_sources, env.action_sources)
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+        self._env(args + ["--no-cache"])
+        self._env(["-s", "b", "print(L)"] + ["--no-cache"])
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+    def testScript(self):
+        fd, script = tempfile.mkstemp()
+        os.write(fd, b"a = 1\n")
+        os.close(fd)
+        try:
+            env = self._env(["-s", "a", "print(L)"], script)
+            self.assertEqual(env.build_script().co_names, ('a',))
+            self.assertEqual(len(os.listdir(self.cachedir)), 2)
+
+            with open(script, "w") as f:
+                f.write("b = 1\n")
+            os.utime(script, (0, 0))
+            self.assertEqual(env.build_script().co_names, ('b',))
+            self.assertEqual(len(os.listdir(self.cachedir)), 3)
+        finally:
+            os.unlink(script)
+
+    def testBroken(self):
+        cache = tse.main.CodeCache()
+        key = cache.key('test')
+        with open(cache.filename(key), 'wb') as f:
+            f.write(b'broken')
+        self.assertEqual(cache.get(key), None)
+
+        cache.set(cache.key('other'), 1)
+        os.rename(cache.filename(cache.key('other')), cache.filename(key))
+        self.assertEqual(cache.get(key), None)
+
+    def testEvict(self):
+        cache = tse.main.CodeCache(maxsize=2500)
+        for i in range(5):
+            cache.set(cache.key(i), b'x' * 1000)
+            os.utime(cache.filename(cache.key(i)), (i, i))
+        cache.set(cache.key(5), b'x' * 1000)
+        self.assertEqual(sorted(os.listdir(self.cachedir)),
+                         sorted(os.path.basename(cache.filename(cache.key(i)))
+                                for i in (4, 5)))
+
+
+class TestNamespace(_TestBase):
+
+    def testLazy(self):
+        globals = self._run(["-s", "(?P<x>a)", "y=S0+L1+x"], u"a b\n")
+        self.assertEqual(globals['y'], u"aaa")
+        self.assertTrue('os' in globals)
+        self.assertFalse('glob' in globals)
+        self.assertFalse('Path' in globals)
+
+    def testImport(self):
+        for action in ["x=glob", "x=C", "x=eval('Path')"]:
+            globals = self._run(["-s", "", action], u"a\n")
+            self.assertTrue('glob' in globals)
+            self.assertEqual(globals['C'], globals['Path']())
+            self.testfile.close()
+            os.unlink(self.testfilename)
+            self.testfilename = None
+
+    def testStartupProfile(self):
+        sys.stderr = err = StringIO()
+        try:
+            self._run(["-s", "", "", "--startup-profile"], u"")
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertTrue(re.match(
+            r"tse: startup: interpreter [\d.]+ms, .* namespace [\d.]+ms, begin [\d.]+ms, "
+            r"total [\d.]+ms, \d+ modules\n", err.getvalue()))
+
+
+@unittest.skipUnless(hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX'),
+                     'requires fork() and Unix domain socket')
+class TestServer(_TestBase):
+
+    def setUp(self):
+        super(TestServer, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        self.environ['TSE_SOCKET'] = os.path.join(self.tmpdir, 'tse.sock')
+        self.environ['PYTHONPATH'] = os.path.dirname(os.path.dirname(tse.main.__file__))
+        self.server = subprocess.Popen(
+            [sys.executable, '-m', 'tse.main', '--server', '--idle-timeout', '10',
+             '--workers', '2', '-m', 'json'],
+            env=self.environ)
+        for i in range(100):
+            if os.path.exists(self.environ['TSE_SOCKET']):
+                break
+            time.sleep(0.1)
+
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.tmpdir)
+        super(TestServer, self).tearDown()
+
+    def _client(self, args, input=b'', cwd=None):
+        p = subprocess.Popen([sys.executable, '-m', 'tse.client'] + args, env=self.environ,
+                             cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        out, err = p.communicate(input)
+        return p.returncode, out, err
+
+    def testRequest(self):
+        self.environ['TSE_TEST'] = 'abc'
+        status, out, err = self._client(
+            ['-m', 'json', '-s', 'a', 'P(json.dumps([L, os.getcwd(), os.environ["TSE_TEST"]]))'],
+            b'a\nb\n', cwd=self.tmpdir)
+        self.assertEqual((status, err), (0, b''))
+        self.assertEqual(json.loads(out.decode('utf-8')),
+                         ['a', os.path.realpath(self.tmpdir), 'abc'])
+
+    def testIsolation(self):
+        status, out, err = self._client(['-x', 'json'])
+        self.assertEqual(status, 1)
+        self.assertTrue(b"NameError" in err)
+
+        self._client(['-x', 'sys.modules["json"].x = 1'])
+        status, out, err = self._client(['-x', 'P(hasattr(sys.modules["json"], "x"))'])
+        self.assertEqual(out, b'False\n')
+
+    def testStatus(self):
+        self.assertEqual(self._client(['-x', 'sys.exit(3)'])[0], 3)
+        self.assertEqual(self._client(['--unknown'])[0], 2)
+
+    def testIdleTimeout(self):
+        self.server.terminate()
+        self.server.wait()
+        self.server = subprocess.Popen(
+            [sys.executable, '-m', 'tse.main', '--server', '--idle-timeout', '0.5'],
+            env=self.environ)
+        self.assertEqual(self.server.wait(10), 0)
+        self.assertFalse(os.path.exists(self.environ['TSE_SOCKET']))
+
+    def testInsecureDirectory(self):
+        os.chmod(self.tmpdir, 0o755)
+        # Executed by the client itself, not by a process forked from the server.
+        status, out, err = self._client(['-s', 'a', 'P(os.getppid())'], b'a\n')
+        self.assertEqual((status, out), (0, b'%d\n' % os.getpid()))
+        self.assertTrue(b'server is not used' in err)
+        self.assertRaises(RuntimeError, tse.client.listen, self.environ['TSE_SOCKET'])
+
+        link = os.path.join(self.tmpdir, 'link')
+        os.chmod(self.tmpdir, 0o700)
+        os.symlink(self.tmpdir, link)
+        self.assertRaises(PermissionError, tse.client.connect, os.path.join(link, 'tse.sock'))
+
+    def testPeer(self):
+        a, b = socket.socketpair()
+        try:
+            tse.client.check_peer(a)
+        finally:
+            a.close()
+            b.close()
+
+    def testFallback(self):
+        self.server.terminate()
+        self.server.wait()
+        status, out, err = self._client(['-x', 'P(1)'])
+        self.assertEqual((status, out), (0, b'1\n'))
+
+
+class TestStats(_TestBase):
+
+    def _runStats(self, args, input):
+        sys.stdout = StringIO()
+        sys.stderr = err = StringIO()
+        try:
+            self._run(args + ["--stats"], input)
+        finally:
+            sys.stderr = sys.__stderr__
+        return err.getvalue()
+
+    def testStats(self):
+        err = self._runStats(["-s", "a", "P(L)", "-s", "(b)", "x=L1"], u"a\nb\nc\nab\n")
+        self.assertTrue(re.search(
+            r"statement 1 'a': tested 4, matched 2, search [\d.]+ms, bind [\d.]+ms, "
+            r"exec [\d.]+ms\n", err))
+        self.assertTrue(re.search(r"statement 2 '\(b\)': tested 2, matched 1, ", err))
+        self.assertTrue(re.search(r"file .*: 4 lines, 9 chars, ", err))
+        self.assertTrue(re.search(r"total: 4 lines, 9 chars read, \d+ bytes written", err))
+
+    def testMerge(self):
+        stats = tse.main.Stats(tse.main.Env(
+            None, [("statement", ["a"])], None, None, None, None, None, None, None,
+            None, False, None, []))
+        stats.tested = [1]
+        stats.files = [('a', 1, 1, 0.1)]
+        other = pickle.loads(pickle.dumps(stats))
+        stats.merge(other)
+        self.assertEqual(stats.tested, [2])
+        self.assertEqual(len(stats.files), 2)
+
+    def testProfile(self):
+        import pstats
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            sys.stdout = StringIO()
+            self._run(["-s", "", "P(L.upper())", "--profile", filename], u"a\n")
+            self.assertTrue(pstats.Stats(filename).total_calls)
+        finally:
+            os.unlink(filename)
+
+
+class TestCommands(_TestBase):
+
+    def testJobs(self):
+        sys.stdout = out = StringIO()
+        input = u"".join(u"%d\n" % i for i in range(20))
+        self._run(["--command-jobs", "4", "-s", "", "n=int(L)",
+                   "P(L, E('sleep 0.0%d; echo %d' % (9 - n % 10, n)).strip() + '!')",
+                   "print(n)", "-e", "P(E('echo end'))"], input)
+        self.assertEqual(out.getvalue(), u"".join(
+            u"%d %d!\n%d\n" % (i, i, i) for i in range(20)) + u"end\n\n")
+
+    def testConvert(self):
+        sys.stdout = out = StringIO()
+        self._run(["--command-jobs", "2", "-b", "l=[]", "-s", "",
+                   "P(E('sleep 0.1'), l)", "l.append(L)"], u"a\nb\n")
+        self.assertEqual(out.getvalue(), u" []\n ['a']\n")
+
+    def testResult(self):
+        pool = tse.main.CommandPool(jobs=2)
+        result = pool.E('echo abc def')
+        self.assertTrue(isinstance(result, tse.main.CommandResult))
+        self.assertEqual(result.split()[1], u"def")
+        self.assertEqual(result[:3] + u"!", u"abc!")
+        self.assertEqual(u"%s" % result, u"abc def\n")
+        self.assertEqual(len(result), 8)
+        self.assertTrue(u"abc" in result)
+
+        number = pool.E('echo 12')
+        self.assertEqual(int(number), 12)
+        self.assertEqual(float(number), 12.0)
+        self.assertEqual(list(range(10))[number.strip()[:1]], 1)
+        self.assertEqual(re.search(u"d(e)", str(result)).group(1), u"e")
+        pool.close()
+
+    def testCache(self):
+        pool = tse.main.CommandPool(cache_size=2)
+        first = pool.E('date +%N')
+        pool.E('echo 1')
+        self.assertEqual(pool.E('date +%N'), first)
+        pool.E('echo 2')
+        self.assertEqual(list(pool.cache), ['date +%N', 'echo 2'])
+
+    def testTimeout(self):
+        pool = tse.main.CommandPool(timeout=0.1)
+        self.assertRaises(subprocess.TimeoutExpired, pool.E, 'sleep 1')
+
+        pool = tse.main.CommandPool(jobs=2, timeout=0.1)
+        self.assertRaises(subprocess.TimeoutExpired, pool.E('sleep 1').value)
+        pool.close()
+
+
+class TestFields(_TestBase):
+
+    def testLiteral(self):
+        self.assertEqual(tse.main._literal(re.compile(u",")), u",")
+        self.assertEqual(tse.main._literal(re.compile(u"\\t::")), u"\t::")
+        self.assertEqual(tse.main._literal(re.compile(b"\\|")), b"|")
+        self.assertEqual(tse.main._literal(re.compile(u",+")), None)
+        self.assertEqual(tse.main._literal(re.compile(u"a|b")), None)
+        self.assertEqual(tse.main._literal(re.compile(u"(?i)x")), None)
+        self.assertEqual(tse.main._literal(re.compile(u"")), None)
+
+    def testSeparator(self):
+        for compile_loop in [[], ["--compile"]]:
+            for fs, n in [(u":", 4), (u":+", 3)]:
+                globals = self._run(["-F", fs, "-b", "l=[]", "-s", "", "l.append((L0, N, L2))"]
+                                    + compile_loop, u"a:b::c\n")
+                self.assertEqual(globals['l'], [(re.split(fs, u"a:b::c"), n, u"b")])
+                self.testfile.close()
+                os.unlink(self.testfilename)
+                self.testfilename = None
+
+    def testCSV(self):
+        globals = self._run(["--csv", "-b", "l=[]", "-s", "", "l.append((L0, N, L2))"],
+                            u'a,"b,c",d\n"x ""y""",\n')
+        self.assertEqual(globals['l'], [([u'a', u'b,c', u'd'], 3, u'b,c'),
+                                        ([u'x "y"', u''], 2, u'')])
+
+    def testTSV(self):
+        globals = self._run(["--tsv", "--compile", "-b", "l=[]", "-s", "", "l.append(L0)"],
+                            u'a\t"b\tc"\n')
+        self.assertEqual(globals['l'], [[u'a', u'b\tc']])
+
+    def testWidths(self):
+        globals = self._run(["--widths", "2,3,4", "-b", "l=[]", "-s", "", "l.append((L0, N))"],
+                            u'abcdefghijk\nabc\n')
+        self.assertEqual(globals['l'], [([u'ab', u'cde', u'fghi'], 3), ([u'ab', u'c'], 2)])
+
+        self.assertRaises(SystemExit, self._getParser().parse_args, ["--widths", "2,x"])
+        self.assertRaises(SystemExit, self._getParser().parse_args, ["--widths", "2,0"])
+
+
+class TestRecords(_TestBase):
+
+    def _records(self, data, separator, paragraph=False):
+        # Small blocks to split records across blocks.
+        stream = io.BytesIO(data) if isinstance(data, bytes) else io.StringIO(data)
+        return list(tse.main.RecordReader(stream, separator, paragraph, block_size=3))
+
+    def testLiteral(self):
+        self.assertEqual(self._records(u"ab::cdefg::::h::", u"::"),
+                         [u"ab", u"cdefg", u"", u"h"])
+        self.assertEqual(self._records(b"a\0bcdefgh\0i", b"\0"), [b"a", b"bcdefgh", b"i"])
+        self.assertEqual(self._records(u"", u"::"), [])
+
+    def testRegex(self):
+        self.assertEqual(self._records(u"ab,,,cdefg,h,", re.compile(u",+")), [u"ab", u"cdefg", u"h"])
+        self.assertEqual(self._records(u"E1\n a\n b\nE2\n c\n", re.compile(u"\n(?=\\S)")),
+                         [u"E1\n a\n b", u"E2\n c\n"])
+        self.assertEqual(self._records(b"a1b22c", re.compile(b"\\d*")), [b"a", b"b", b"c"])
+
+    def testParagraph(self):
+        self.assertEqual(self._records(u"\n\n\na\nb\n\n\n\n\nc\n\n", re.compile(u"\n\n+"), True),
+                         [u"a\nb", u"c"])
+
+    def testRun(self):
+        for args in [[], ["--compile"], ["--scan"]]:
+            globals = self._run(["--rs", "", "-b", "l=[]", "-s", "b", "l.append((LINENO, L, N))"]
+                                + args, u"a\nb\n\nc\n\n\nb c\n")
+            self.assertEqual(globals['l'], [(1, u"a\nb", 2), (3, u"b c", 2)])
+            self.testfile.close()
+            os.unlink(self.testfilename)
+            self.testfilename = None
+
+        globals = self._run(["--bytes", "--rs", "\\0", "-b", "l=[]", "-s", "", "l.append(L)"],
+                            u"x y\0z\n\0")
+        self.assertEqual(globals['l'], [b"x y", b"z"])
+
+
+class TestStop(_TestBase):
+
+    def setUp(self):
+        super(TestStop, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.filenames = []
+        for i in range(2):
+            filename = os.path.join(self.tmpdir, str(i))
+            with io.open(filename, 'w') as f:
+                f.write(u"".join(u"%d %d\n" % (i, n) for n in range(10)))
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestStop, self).tearDown()
+
+    def _runFiles(self, args):
+        args = self._getParser().parse_args(args + ['--'] + self.filenames)
+        env = tse.main.Env(args.execute, args.statement, args.begin, args.end,
+                           args.input_encoding, args.output_encoding, args.module,
+                           args.module_star, args.script_file, args.inplace, args.ignore_case,
+                           args.field_separator, args.FILE, compile_loop=args.compile_loop,
+                           stats=args.stats, record_separator=args.record_separator,
+                           max_count=args.max_count,
+                           max_count_per_file=args.max_count_per_file)
+        return tse.main.run(env)
+
+    def testStop(self):
+        for args in [[], ["--compile"]]:
+            globals = self._runFiles(["-b", "l=[]", "-s", "5", "l.append(L); STOP()",
+                                      "-s", "", "l.append(L)", "-e", "l.append('end')"] + args)
+            self.assertEqual(globals['l'], [u"0 0", u"0 1", u"0 2", u"0 3", u"0 4", u"0 5",
+                                            u"end"])
+
+    def testStopFile(self):
+        globals = self._runFiles(["-b", "l=[]", "-s", "^. 1$", "STOP(file=True)",
+                                  "-s", "", "l.append(L)"])
+        self.assertEqual(globals['l'], [u"0 0", u"1 0"])
+
+    def testMaxCount(self):
+        for args in [[], ["--compile"], ["--stats"]]:
+            sys.stderr = StringIO()
+            try:
+                globals = self._runFiles(["--max-count", "3", "-b", "l=[]", "-s", "[13]$",
+                                          "l.append(L)"] + args)
+            finally:
+                sys.stderr = sys.__stderr__
+            self.assertEqual(globals['l'], [u"0 1", u"0 3", u"1 1"])
+
+        globals = self._runFiles(["--max-count-per-file", "2", "-b", "l=[]", "-s", "[2-9]$",
+                                  "l.append(L)"])
+        self.assertEqual(globals['l'], [u"0 2", u"0 3", u"1 2", u"1 3"])
+
+        self.assertRaises(SystemExit, tse.main.main, ["--max-count", "0", "-s", "", "-"])
+        self.assertRaises(SystemExit, tse.main.main, ["--max-count", "1", "-j", "2",
+                                                      "-s", "", "-"])
+
+    def testInplace(self):
+        self._runFiles(["--inplace", ".bak", "-s", "0 2", "P('stop'); STOP()",
+                        "-s", "", "P(L.upper())"])
+        with io.open(self.filenames[0]) as f:
+            self.assertEqual(f.read(), u"0 0\n0 1\nstop\n" +
+                             u"".join(u"0 %d\n" % n for n in range(3, 10)))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["0", "0.bak", "1"])
+
+        # --record-separator reads ahead of records.
+        self._runFiles(["--inplace", ".bak", "--rs", " ", "-s", "^1$", "P('x', end=' '); STOP()",
+                        "-s", "", "P(L, end=' ')"])
+        with io.open(self.filenames[1]) as f:
+            self.assertEqual(f.read(), u"x " + u"".join(u"1 %d\n" % n for n in range(10))[2:])
+
+    def testBrokenPipe(self):
+        environ = dict(os.environ)
+        environ['PYTHONPATH'] = os.path.dirname(os.path.dirname(tse.main.__file__))
+        endfile = os.path.join(self.tmpdir, 'end')
+        p = subprocess.Popen(
+            [sys.executable, '-m', 'tse.main', '--no-cache', '-s', '', 'P(L)',
+             '-e', 'P("end"); open(%r, "w").close()' % endfile],
+            env=environ, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p.stdout.close()
+        out, err = p.communicate(b"abc\n" * 1000000)
+        self.assertEqual(err, b"")
+        self.assertEqual(p.returncode, 0)
+        self.assertTrue(os.path.exists(endfile))
+
+    def testBrokenPipeAtMatch(self):
+        # An error of the output thread is raised at the next matched line,
+        # without waiting for the output buffer to be filled.
+        class Raw(io.RawIOBase):
+            def writable(self):
+                return True
+
+            def write(self, b):
+                raise BrokenPipeError()
+
+        for compile_loop in (False, True):
+            args = self._getParser().parse_args(["-s", "", "n.append(L)"])
+            env = tse.main.Env(args.execute, args.statement, args.begin, args.end,
+                               args.input_encoding, args.output_encoding, args.module,
+                               args.module_star, args.script_file, args.inplace,
+                               args.ignore_case, args.field_separator, None,
+                               compile_loop=compile_loop)
+            writer = tse.main.AsyncWriter(Raw())
+            writer.write(b"abc")
+            writer._queue.join()
+
+            globals = {'n': [], '__tse_output': writer}
+            self.assertRaises(BrokenPipeError, tse.main._run_script,
+                              env, [u"a\n", u"b\n"], '<stdin>', globals, globals)
+            self.assertEqual(globals['n'], [u"a"])
+            writer.close()
+
+
+class TestBatch(_TestBase):
+
+    def testBatch(self):
+        globals = self._run(["--batch", "2", "-b", "l=[]",
+                             "-s", "^\\d", "l.append((LINENOS, LINES))",
+                             "-s", "", "l.append(('other', LINES))"],
+                            u"1 a\n2 b\nx\n3\n4 c\n5\n")
+        self.assertEqual(globals['l'], [([1, 2], [u"1 a", u"2 b"]),
+                                        ([4, 5], [u"3", u"4 c"]),
+                                        ([6], [u"5"]),
+                                        ('other', [u"x"])])
+
+    def testFields(self):
+        globals = self._run(["--batch", "10", "-F", ",", "-s", "",
+                             "n=sum(map(int, FIELDS[1])); c=FIELDS[2]; r=FIELDS[0]"],
+                            u"1,a\n2\n3,b\n")
+        self.assertEqual(globals['n'], 6)
+        self.assertEqual(globals['c'], [u"a", None, u"b"])
+        self.assertEqual(globals['r'], [[u"1", u"a"], [u"2"], [u"3", u"b"]])
+
+    def testMaxCount(self):
+        globals = self._run(["--batch", "2", "--max-count", "3", "-b", "l=[]",
+                             "-s", "", "l.append(LINES)"], u"a\nb\nc\nd\n")
+        self.assertEqual(globals['l'], [[u"a", u"b"], [u"c"]])
+
+    def testDefaultAction(self):
+        for args in [[], ["--bytes"]]:
+            sys.stdout = StringIO()
+            self._run(["--batch", "2", "-s", "", ""] + args, u"a\nb\nc\n")
+            self.assertEqual(sys.stdout.getvalue(), u"a\nb\nc\n")
+
+
+class TestAggregate(_TestBase):
+
+    def _merged(self, cls, values, **kwargs):
+        # Values are split into two aggregators, pickled and merged.
+        a, b = cls(**kwargs), cls(**kwargs)
+        a.update(values[::2])
+        b.update(values[1::2])
+        return tse.main.merge(pickle.loads(pickle.dumps(a)), pickle.loads(pickle.dumps(b)))
+
+    def testCount(self):
+        from tse.aggregate import Count
+        c = self._merged(Count, list(u"abracadabra"))
+        self.assertEqual(c[u"a"], 5)
+        self.assertEqual(str(c).splitlines()[0], u"a\t5")
+
+        c = self._merged(Count, list(u"cab"), sort_keys=True)
+        self.assertEqual(str(c), u"a\t1\nb\t1\nc\t1")
+
+    def testTopK(self):
+        from tse.aggregate import TopK
+        values = [n for n in range(1, 1000) for i in range(1000 // n)]
+        random.Random(0).shuffle(values)
+        c = self._merged(TopK, values, k=10)
+        self.assertTrue(len(c.counts) < 20)
+        self.assertEqual([k for k, count in c.most_common(3)], [1, 2, 3])
+        for key, count in c.most_common():
+            self.assertTrue(count - c.error(key) <= 1000 // key <= count)
+
+    def testQuantiles(self):
+        from tse.aggregate import Quantiles
+        values = list(range(100000))
+        random.Random(0).shuffle(values)
+        q = self._merged(Quantiles, values)
+        self.assertEqual(len(q), 100000)
+        self.assertEqual((q.min, q.max), (0, 99999))
+        self.assertTrue(sum(len(level) for level in q.levels) < 600)
+        for p, v in zip([0.1, 0.5, 0.9], q.quantiles([0.1, 0.5, 0.9])):
+            self.assertTrue(abs(v - p * 100000) < 2000)
+        self.assertEqual(str(q).splitlines()[0], u"count\t100000")
+
+    def testDistinct(self):
+        from tse.aggregate import Distinct
+        d = self._merged(Distinct, [u"%d" % (i % 20000) for i in range(100000)])
+        self.assertTrue(abs(d.count() - 20000) < 600)
+        self.assertEqual(len(Distinct()), 0)
+
+    def testNamespace(self):
+        sys.stdout = out = StringIO()
+        self._run(["-b", "c=Count(); d=Distinct()", "-s", "", "c.add(L); d.add(L)",
+                   "-e", "P(c); P(d)"], u"a\nb\na\n")
+        self.assertEqual(out.getvalue(), u"a\t2\nb\t1\n2\n")
+
+
+class TestRecursive(_TestBase):
+
+    FILES = {
+        '.gitignore': b"build/\n*.log\n!keep.log\n/top.txt\n",
+        'top.txt': b"hit\n",
+        'a/x.txt': b"hit\n",
+        'a/top.txt': b"hit\n",
+        'a/b/y.py': b"hit\n",
+        'a/bin.dat': b"hit\0\n",
+        'build/z.txt': b"hit\n",
+        'logs/1.log': b"hit\n",
+        'logs/keep.log': b"hit\n",
+        '.git/config': b"hit\n",
+    }
+
+    def setUp(self):
+        super(TestRecursive, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        for name, data in self.FILES.items():
+            filename = os.path.join(self.tmpdir, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestRecursive, self).tearDown()
+
+    def _env(self, args):
+        args = self._getParser().parse_args(args + ['--', self.tmpdir])
+        return tse.main.Env(args.execute, args.statement, args.begin, args.end,
+                            args.input_encoding, args.output_encoding, args.module,
+                            args.module_star, args.script_file, args.inplace, args.ignore_case,
+                            args.field_separator, args.FILE, bytes_mode=args.bytes_mode,
+                            recursive=args.recursive, include=args.include,
+                            exclude=args.exclude, gitignore=args.gitignore)
+
+    def _files(self, args):
+        env = self._env(args)
+        return [os.path.relpath(f, self.tmpdir) for f in env.iter_files()]
+
+    def testRecursive(self):
+        self.assertEqual(self._files(["-r"]),
+                         [".gitignore", "a/b/y.py", "a/top.txt", "a/x.txt", "logs/keep.log"])
+        self.assertEqual(self._files(["-r", "--bytes", "--include", "*.dat"]), ["a/bin.dat"])
+        self.assertEqual(self._files(["-r", "--include", "*.txt", "--include", "*.py",
+                                      "--exclude", "b"]),
+                         ["a/top.txt", "a/x.txt"])
+        self.assertEqual(len(self._files(["-r", "--no-ignore"])), 9)
+
+        # Directories are not walked without --recursive.
+        self.assertEqual(self._files([]), ["."])
+
+    def testUnreadableDirectory(self):
+        env = self._env(["-r"])
+        dirname = os.path.join(self.tmpdir, 'removed')
+        sys.stderr = err = StringIO()
+        try:
+            self.assertEqual(tse.main._scan_dir(env, dirname, tse.main.IgnoreRules()), [])
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertEqual(err.getvalue(),
+                         u"tse: %s: No such file or directory\n" % dirname)
+
+    def testIgnoreRules(self):
+        rules = tse.main.IgnoreRules().read(self.tmpdir, '')
+        self.assertTrue(rules.ignored("build", "build", True))
+        self.assertFalse(rules.ignored("build", "build", False))
+        self.assertTrue(rules.ignored("x/1.log", "1.log", False))
+        self.assertFalse(rules.ignored("x/keep.log", "keep.log", False))
+        self.assertTrue(rules.ignored("top.txt", "top.txt", False))
+        self.assertFalse(rules.ignored("a/top.txt", "top.txt", False))
+
+        translate = tse.main.IgnoreRules._translate
+        self.assertTrue(translate("a/**/b").match("a/x/y/b"))
+        self.assertTrue(translate("a/**/b").match("a/b"))
+        self.assertFalse(translate("a/*").match("a/b/c"))
+        self.assertTrue(translate("*.[ch]").match("x.h"))
+        self.assertTrue(translate("[a!]x").match("!x"))
+        self.assertFalse(translate("[a!]x").match("^x"))
+        self.assertFalse(translate("[!a]x").match("ax"))
+        self.assertTrue(translate("[!a]x").match("bx"))
+        self.assertTrue(translate("[!]a]").match("b"))
+        self.assertFalse(translate("[!]a]").match("]"))
+        self.assertTrue(translate("[a^]").match("^"))
+        self.assertTrue(translate("[a\\]").match("\\"))
+
+    def testInplace(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        try:
+            tse.main.main(["--no-cache", "-r", "--inplace", ".bak", "--include", "*.txt",
+                           "-s", "", "P(L.upper())"])
+        finally:
+            os.chdir(cwd)
+        with open(os.path.join(self.tmpdir, 'a/x.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b"HIT\n")
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'a/x.txt.bak')))
+        with open(os.path.join(self.tmpdir, 'build/z.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b"hit\n")
+
+
+class TestFollow(_TestBase):
+
+    def setUp(self):
+        super(TestFollow, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'log')
+        self.statefile = os.path.join(self.tmpdir, 'state')
+        self._interval = tse.main.FOLLOW_INTERVAL
+        tse.main.FOLLOW_INTERVAL = 0.01
+
+    def tearDown(self):
+        tse.main.FOLLOW_INTERVAL = self._interval
+        shutil.rmtree(self.tmpdir)
+        super(TestFollow, self).tearDown()
+
+    def _append(self, s, filename=None):
+        with open(filename or self.filename, 'ab') as f:
+            f.write(s)
+
+    def _runLog(self, args, files=None):
+        args = self._getParser().parse_args(args + ['--'] + (files or [self.filename]))
+        env = tse.main.Env(args.execute, args.statement, args.begin, args.end,
+                           args.input_encoding, args.output_encoding, args.module,
+                           args.module_star, args.script_file, args.inplace, args.ignore_case,
+                           args.field_separator, args.FILE, bytes_mode=args.bytes_mode,
+                           max_count=args.max_count, batch=args.batch,
+                           follow=args.follow, state=args.state)
+        return tse.main.run(env)['l']
+
+    def testLogReader(self):
+        self._append(b"a\r\nb\nc")
+        with tse.main.LogReader(self.filename, 'utf-8', block_size=2) as reader:
+            self.assertEqual(list(reader), [u"a", u"b"])
+            self.assertEqual((reader.offset, reader.lineno), (5, 2))
+
+            self._append(b"d\ne\n")
+            lines = iter(reader)
+            self.assertEqual(next(lines), u"cd")
+            self.assertEqual((reader.offset, reader.lineno), (8, 3))
+            self.assertEqual(list(lines), [u"e"])
+
+            self._append(b"f")
+            self.assertEqual(list(reader), [])
+            self.assertEqual(list(reader.drain()), [u"f"])
+            self.assertEqual((reader.offset, reader.lineno), (11, 5))
+
+            reader.seek(5, 2)
+            self.assertEqual(list(reader), [u"cd", u"e"])
+
+        with tse.main.LogReader(self.filename) as reader:
+            self.assertEqual(list(reader), [b"a\r", b"b", b"cd", b"e"])
+
+    def testState(self):
+        args = ["--state", self.statefile, "-b", "l=[]", "-s", "", "l.append((LINENO, L))"]
+        self._append(b"a\nb\nc")
+        self.assertEqual(self._runLog(args), [(1, u"a"), (2, u"b")])
+        self._append(b"\nd\n")
+        self.assertEqual(self._runLog(args), [(3, u"c"), (4, u"d")])
+        self.assertEqual(self._runLog(args), [])
+
+        # Rotated file is read from the offset of the last run.
+        rotated = self.filename + '.1'
+        os.rename(self.filename, rotated)
+        self._append(b"e\n", rotated)
+        self._append(b"x\n")
+        self.assertEqual(self._runLog(args, [rotated, self.filename]),
+                         [(5, u"e"), (1, u"x")])
+
+        # Truncated file is read from the beginning.
+        open(self.filename, 'wb').close()
+        self.assertEqual(self._runLog(args), [])
+        self._append(b"y\n")
+        self.assertEqual(self._runLog(args), [(1, u"y")])
+
+        # Lines after STOP() are read by the next run.
+        self._append(b"1\n2\n3\n")
+        self.assertEqual(self._runLog(["--max-count", "1"] + args), [(2, u"1")])
+        self.assertEqual(self._runLog(["--batch", "2", "--state", self.statefile, "-b", "l=[]",
+                                       "-s", "", "l.extend(zip(LINENOS, LINES))"]),
+                         [(3, u"2"), (4, u"3")])
+
+        self.assertRaises(SystemExit, tse.main.main, ["--state", self.statefile, "-s", "", ""])
+        self.assertRaises(SystemExit, tse.main.main, ["--follow", "-j", "2", "-s", "", "",
+                                                      self.filename])
+
+    def testFollow(self):
+        rotated = self.filename + '.1'
+        self._append(b"1\n")
+        # Lines are appended and the file is rotated by the action itself.
+        action = ("l.append((LINENO, L))\n"
+                  "if L == '1': open(FILENAME, 'a').write('2\\n')\n"
+                  "if L == '2':\n"
+                  "  os.rename(FILENAME, FILENAME + '.1')\n"
+                  "  open(FILENAME + '.1', 'a').write('3')\n"
+                  "  open(FILENAME, 'w').write('4\\n')\n"
+                  "if L == '4': STOP()\n")
+        l = self._runLog(["--follow", "--state", self.statefile, "-m", "os", "-b", "l=[]",
+                          "-s", "", action, "-e", "l.append('end')"])
+        self.assertEqual(l, [(1, u"1"), (2, u"2"), (3, u"3"), (1, u"4"), u"end"])
+
+        with open(self.statefile) as f:
+            state = json.load(f)
+        self.assertEqual(state[rotated]['lineno'], 3)
+        self.assertEqual(state[rotated]['offset'], 5)
+        self.assertEqual(state[self.filename]['offset'], 2)
+
+
+class TestSort(_TestBase):
+
+    INPUT = u"b 2\na 10\nc 1\nb 2\na 10\nb 3\n"
+
+    def _sort(self, args, input=INPUT):
+        sys.stdout = StringIO()
+        self._run(["-s", "", "P(L)", "-e", "P('end')"] + args, input)
+        return sys.stdout.getvalue().splitlines()
+
+    def testSort(self):
+        self.assertEqual(self._sort(["--sort"]),
+                         [u"a 10", u"a 10", u"b 2", u"b 2", u"b 3", u"c 1", u"end"])
+        # Lines of the same key are kept in order.
+        self.assertEqual(self._sort(["--sort", "int(L.split()[1])"], u"x 2\ny 1\nz 2\nw 1\n"),
+                         [u"y 1", u"w 1", u"x 2", u"z 2", u"end"])
+        # Names of the key are imported as names of actions.
+        self.assertEqual(self._sort(["--sort", "Path(L).suffix"], u"a.c\nb.b\nc.a\n"),
+                         [u"c.a", u"b.b", u"a.c", u"end"])
+
+    def testUniq(self):
+        self.assertEqual(self._sort(["--uniq"]), [u"a 10", u"b 2", u"b 3", u"c 1", u"end"])
+        self.assertEqual(self._sort(["--uniq", "--sort=-int(L.split()[1])"]),
+                         [u"a 10", u"b 3", u"b 2", u"c 1", u"end"])
+        self.assertEqual(self._sort(["--uniq-count"]),
+                         [u"      2 a 10", u"      2 b 2", u"      1 b 3", u"      1 c 1",
+                          u"end"])
+        self.assertEqual(self._sort(["--uniq-count", "--bytes"]),
+                         [u"      2 a 10", u"      2 b 2", u"      1 b 3", u"      1 c 1",
+                          u"end"])
+
+        self.assertRaises(SystemExit, tse.main.main, ["--uniq", "--uniq-count", "-s", "", "-"])
+        self.assertRaises(SystemExit, tse.main.main, ["--sort", "--inplace", ".bak",
+                                                      "-s", "", "", "--", "x"])
+
+    def testSpill(self):
+        rand = random.Random(0)
+        lines = [u"%d %s" % (rand.randrange(100), u"x" * rand.randrange(5))
+                 for i in range(2000)]
+        key = lambda line: int(line.split()[0])
+        width = tse.main.MERGE_WIDTH
+        tse.main.MERGE_WIDTH = 4
+        try:
+            for kwargs, expected in [
+                    ({}, sorted(lines)),
+                    ({'key': key}, sorted(lines, key=key)),
+                    ({'uniq': True}, sorted(set(lines))),
+                    ({'count': True},
+                     [u"%7d %s" % (lines.count(line), line) for line in sorted(set(lines))])]:
+                out = StringIO()
+                sorter = tse.main.SortedOutput(out, memory=1000, **kwargs)
+                for line in lines:
+                    sorter.write(line + u"\n")
+                    sorter._add_lines()
+                self.assertTrue(sorter._runs)
+                sorter.finish()
+                sorter.close()
+                self.assertEqual(out.getvalue().splitlines(), expected)
+        finally:
+            tse.main.MERGE_WIDTH = width
+
+    def testSpillCarriageReturn(self):
+        # Records of temporary files are separated only by \n.
+        lines = [u"%d\r%s\rX" % (i % 7, i % 3) for i in range(200)]
+        for kwargs, expected in [
+                ({}, sorted(lines)),
+                ({'count': True},
+                 [u"%7d %s" % (lines.count(line), line) for line in sorted(set(lines))])]:
+            out = StringIO()
+            sorter = tse.main.SortedOutput(out, memory=100, **kwargs)
+            for line in lines:
+                sorter.write(line + u"\n")
+                sorter._add_lines()
+            self.assertTrue(sorter._runs)
+            sorter.finish()
+            sorter.close()
+            self.assertEqual(out.getvalue().split(u"\n"), expected + [u""])
+
+
+class TestProcessor(_TestBase):
+
+    def testRun(self):
+        proc = tse.compile([(r"(\w+) (\d+)", "total[S1] = total.get(S1, 0) + int(S2)")],
+                           begin="total = {}")
+        self.assertEqual(proc.run([u"a 1", u"b 2", u"a 3"])['total'], {u"a": 4, u"b": 2})
+        # Each run has a new namespace.
+        self.assertEqual(proc.run([u"c 1\n"])['total'], {u"c": 1})
+
+    def testOutput(self):
+        proc = tse.compile([("ERROR", "P(FILENAME, LINENO, L2)"), ("", ["n += 1"])],
+                           begin="n = 0", end="print('n', n)")
+        self.assertEqual(proc.getoutput([u"x ERROR", u"y"], StringIO(u"ERROR z\n")),
+                         u"<input> 1 ERROR\n<input> 1 z\nn 1\n")
+
+        fd, self.testfilename = tempfile.mkstemp()
+        with io.open(fd, 'w') as f:
+            f.write(u"a ERROR\n")
+        out = StringIO()
+        proc.run(self.testfilename, output=out)
+        self.assertEqual(out.getvalue(), u"%s 1 ERROR\nn 0\n" % self.testfilename)
+
+    def testOptions(self):
+        proc = tse.compile([("", "P(L1)")], field_format='csv', max_count=2)
+        self.assertEqual(proc.getoutput([u'"a,b",c', u"d,e", u"f"]), u"a,b\nd\n")
+        self.assertEqual(proc.getoutput([u"g,h"]), u"g\n")
+
+        proc = tse.compile([("", "P(L)")], uniq_count=True, end="P('end')")
+        self.assertEqual(proc.getoutput([u"b", u"a", u"b"]), u"      1 a\n      2 b\nend\n")
+
+        self.assertRaises(TypeError, tse.compile, [("", "P(L)")], jobs=2)
+
+    def testThreads(self):
+        import threading
+        proc = tse.compile([(r"(\d+)", "n += int(S1)")], begin="n = 0", end="P(n)",
+                           compile_loop=True)
+        results = {}
+
+        def run(i):
+            results[i] = set(proc.getoutput([str(i)] * 100) for n in range(20))
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, dict((i, set([u"%d\n" % (i * 100)])) for i in range(4)))
+
+
 class TestIndent(_TestBase):
 
     def testIndent(self):
@@ -0,0 +1 @@
+from tse.processor import compile, Processor
@@ -0,0 +1,293 @@
+# -*- coding:utf-8 -*-
+"""Streaming aggregators available in actions.
+
+All aggregators are picklable, and can be merged with ``merge()`` so that
+values computed by ``--jobs`` workers are combined. ``str()`` of an
+aggregator is a summary to be printed by ``--end``. Except ``Count``,
+memory used by an aggregator does not grow with the number of values.
+"""
+
+import collections
+import heapq
+import operator
+import random
+
+__all__ = ['Count', 'TopK', 'Quantiles', 'Distinct']
+
+
+def _format(items):
+    return u'\n'.join(u'%s\t%s' % item for item in items)
+
+
+class Count(collections.Counter):
+    """Exact counter of keys.
+
+    ``str()`` lists keys by descending count, or in order of keys if
+    ``sort_keys`` is true.
+    """
+
+    def __init__(self, iterable=None, sort_keys=False, **kwargs):
+        super(Count, self).__init__()
+        self.sort_keys = sort_keys
+        self.update(iterable, **kwargs)
+
+    def __reduce__(self):
+        return self.__class__, (dict(self), self.sort_keys)
+
+    def add(self, key, n=1):
+        self[key] += n
+
+    def merge(self, other):
+        """Add counts of other to this counter and return it."""
+        self.update(other)
+        return self
+
+    def __str__(self):
+        if self.sort_keys:
+            return _format(sorted(self.items()))
+        return _format(self.most_common())
+
+
+class TopK(object):
+    """Approximate counter of the most frequent ``k`` keys.
+
+    Counts are overestimated at most by ``error(key)``. Keys are counted as
+    Space-Saving algorithm, but keys with the least counts are dropped at
+    once when the number of keys reaches ``2 * k``.
+    """
+
+    def __init__(self, k=100):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        # Largest count of the keys dropped.
+        self.floor = 0
+
+    def add(self, key, n=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += n
+            return
+        counts[key] = self.floor + n
+        self.errors[key] = self.floor
+        if len(counts) >= 2 * self.k:
+            self._prune()
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def _prune(self):
+        items = heapq.nlargest(self.k + 1, self.counts.items(), key=operator.itemgetter(1))
+        if len(items) > self.k:
+            self.floor = max(self.floor, items.pop()[1])
+        errors = self.errors
+        self.errors = dict((key, errors[key]) for key, count in items)
+        self.counts = dict(items)
+
+    def merge(self, other):
+        """Add counts of other to this counter and return it."""
+        counts, errors = self.counts, self.errors
+        for key in counts:
+            if key not in other.counts:
+                counts[key] += other.floor
+                errors[key] += other.floor
+        for key, count in other.counts.items():
+            if key in counts:
+                counts[key] += count
+                errors[key] += other.errors[key]
+            else:
+                counts[key] = count + self.floor
+                errors[key] = other.errors[key] + self.floor
+        self.floor += other.floor
+        if len(counts) > self.k:
+            self._prune()
+        return self
+
+    def error(self, key):
+        return self.errors.get(key, self.floor)
+
+    def most_common(self, n=None):
+        """List of ``(key, count)`` of the most frequent keys."""
+        if n is None or n > self.k:
+            n = self.k
+        return heapq.nlargest(n, self.counts.items(), key=operator.itemgetter(1))
+
+    def __getitem__(self, key):
+        return self.counts.get(key, self.floor)
+
+    def __str__(self):
+        return _format(self.most_common())
+
+
+class Quantiles(object):
+    """Approximate quantiles of numbers.
+
+    Values are sampled by KLL sketch in at most ``3 * k`` items. Ranks of
+    the quantiles are usually within ``2 / k`` (1% with the default k) of
+    exact ones. ``min`` and ``max`` are exact.
+    """
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, k=200):
+        self.k = k
+        # Items of levels[h] have weight 2 ** h.
+        self.levels = [[]]
+        self.count = 0
+        self._min = self._max = None
+        self._random = random.Random(0)
+
+    def add(self, value):
+        level = self.levels[0]
+        level.append(value)
+        self.count += 1
+        if len(level) >= self.k:
+            self._compress()
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def _capacity(self, h):
+        return max(2, int(self.k * (2.0 / 3) ** (len(self.levels) - h - 1)))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            items = self.levels[h]
+            if len(items) >= self._capacity(h):
+                items.sort()
+                if h == 0:
+                    self._min, self._max = self._range(items[0], items[-1])
+                keep = [items.pop()] if len(items) % 2 else []
+                # Every other item is promoted with doubled weight.
+                promoted = items[self._random.getrandbits(1)::2]
+                self.levels[h] = keep
+                if h + 1 == len(self.levels):
+                    self.levels.append([])
+                self.levels[h + 1].extend(promoted)
+            h += 1
+
+    def _range(self, lo, hi):
+        if self._min is not None:
+            lo, hi = min(self._min, lo), max(self._max, hi)
+        return lo, hi
+
+    @property
+    def min(self):
+        if self.levels[0]:
+            return self._range(min(self.levels[0]), max(self.levels[0]))[0]
+        return self._min
+
+    @property
+    def max(self):
+        if self.levels[0]:
+            return self._range(min(self.levels[0]), max(self.levels[0]))[1]
+        return self._max
+
+    def merge(self, other):
+        """Add values of other to this sketch and return it."""
+        if other._min is not None:
+            self._min, self._max = self._range(other._min, other._max)
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for h, items in enumerate(other.levels):
+            self.levels[h].extend(items)
+        self.count += other.count
+        self._compress()
+        return self
+
+    def quantiles(self, qs):
+        """List of values at quantiles ``qs`` (0 <= q <= 1)."""
+        items = sorted((value, 1 << h)
+                       for h, level in enumerate(self.levels)
+                       for value in level)
+        total = sum(w for v, w in items)
+        ret = []
+        for q in qs:
+            if not items:
+                ret.append(None)
+            elif q <= 0:
+                ret.append(self.min)
+            elif q >= 1:
+                ret.append(self.max)
+            else:
+                rank = q * total
+                cum = 0
+                for value, weight in items:
+                    cum += weight
+                    if cum >= rank:
+                        break
+                ret.append(value)
+        return ret
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        items = [(u'count', self.count), (u'min', self.min)]
+        items.extend((u'p%g' % (q * 100), v)
+                     for q, v in zip(self.QUANTILES, self.quantiles(self.QUANTILES)))
+        items.append((u'max', self.max))
+        return _format(items)
+
+
+def _hash64(key):
+    import hashlib
+    if not isinstance(key, bytes):
+        if not isinstance(key, str):
+            key = repr(key)
+        key = key.encode('utf-8', 'surrogateescape')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+class Distinct(object):
+    """Approximate number of distinct keys by HyperLogLog.
+
+    ``2 ** p`` bytes are used, and the standard error is about
+    ``1.04 / sqrt(2 ** p)`` (0.8% with the default p).
+    """
+
+    def __init__(self, p=14):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, key):
+        h = _hash64(key)
+        bits = 64 - self.p
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def merge(self, other):
+        """Add keys of other to this counter and return it."""
+        if other.p != self.p:
+            raise ValueError('cannot merge Distinct of different p')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting for small cardinalities.
+            import math
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    def __str__(self):
+        return str(self.count())
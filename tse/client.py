@@ -0,0 +1,175 @@
+# -*- coding:utf-8 -*-
+"""Client of ``tse --server``.
+
+The command line arguments, current directory, environment variables and
+the standard streams are passed to the server, and the action is executed
+by the server. If the server is not running, tse is executed in this
+process.
+
+This module is kept small so that the client starts quickly.
+"""
+
+import sys
+import os
+import stat
+import socket
+import struct
+import json
+import array
+
+HEADER = struct.Struct('!I')
+
+# struct ucred of SO_PEERCRED.
+UCRED = struct.Struct('3i')
+
+
+def socket_path():
+    """Returns the path of the socket of the server."""
+    if os.environ.get('TSE_SOCKET'):
+        return os.environ['TSE_SOCKET']
+    dirname = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(dirname, 'tse-%d' % os.getuid(), 'server.sock')
+
+
+def check_dir(dirname):
+    """Raises PermissionError unless the directory is owned by the current
+    user and not accessible by others, so that other users can not create
+    the socket in it."""
+    st = os.lstat(dirname)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError('%s: not a directory' % dirname)
+    if st.st_uid != os.getuid():
+        raise PermissionError('%s: not owned by the current user' % dirname)
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        raise PermissionError('%s: mode should be 0700' % dirname)
+
+
+def check_peer(sock):
+    """Raises PermissionError if the process on the other end of the socket
+    is not of the current user. Not checked if SO_PEERCRED is not
+    supported."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return
+    pid, uid, gid = UCRED.unpack(
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, UCRED.size))
+    if uid != os.getuid():
+        raise PermissionError('peer of the socket is not the current user: uid %d' % uid)
+
+
+def listen(path):
+    """Creates a socket to accept clients.
+
+    Raises RuntimeError if another server is listening on the path, or the
+    directory of the path may be written by other users.
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.lexists(dirname):
+        os.makedirs(dirname, 0o700)
+    try:
+        check_dir(dirname or os.curdir)
+    except OSError as e:
+        raise RuntimeError('insecure socket directory: %s' % e)
+
+    if os.path.exists(path):
+        try:
+            connect(path).close()
+        except OSError:
+            # Remove the socket file left by a dead server.
+            os.unlink(path)
+        else:
+            raise RuntimeError('server is already running: %s' % path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(16)
+    return sock
+
+
+def connect(path):
+    """Connects to the server. Raises PermissionError if the socket or the
+    server may be of other users."""
+    check_dir(os.path.dirname(path) or os.curdir)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        check_peer(sock)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _recv(sock, size):
+    buf = b''
+    while len(buf) < size:
+        data = sock.recv(size - len(buf))
+        if not data:
+            raise EOFError('connection closed')
+        buf += data
+    return buf
+
+
+def send_request(sock, request, fds):
+    data = json.dumps(request).encode('utf-8')
+    sock.sendmsg([HEADER.pack(len(data)) + data],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+def recv_request(sock, maxfds=3):
+    """Returns a tuple of the request and the file descriptors."""
+    fds = array.array('i')
+    data, ancdata, flags, addr = sock.recvmsg(
+        HEADER.size, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, type, cdata in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+
+    if not data:
+        raise EOFError('connection closed')
+    data += _recv(sock, HEADER.size - len(data))
+    size, = HEADER.unpack(data)
+    request = json.loads(_recv(sock, size).decode('utf-8'))
+    return request, list(fds)
+
+
+def send_status(sock, status):
+    sock.sendall(HEADER.pack(status))
+
+
+def recv_status(sock):
+    return HEADER.unpack(_recv(sock, HEADER.size))[0]
+
+
+def main():
+    try:
+        sock = connect(socket_path())
+    except OSError as e:
+        if isinstance(e, PermissionError):
+            sys.stderr.write('tse: server is not used: %s\n' % e)
+        from tse.main import main
+        return main()
+
+    request = {
+        'argv': sys.argv[1:],
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+    }
+    try:
+        send_request(sock, request, [0, 1, 2])
+        status = recv_status(sock)
+    except KeyboardInterrupt:
+        status = 130
+    except (OSError, EOFError) as e:
+        sys.stderr.write('tse: lost connection to server: %s\n' % e)
+        status = 1
+    finally:
+        sock.close()
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
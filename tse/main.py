@@ -1,27 +1,261 @@
 # -*- coding:utf-8 -*-
 
+import time
+# (name, time) of each step of startup. See --startup-profile.
+_STARTUP = [('start', time.time())]
+_STARTUP_CPU = time.process_time()
+
 import sys
 import argparse
 import re
 import locale
-import ast
 import codecs
-import fileinput
 import os
+import stat
 import six
 import io
-import shutil
-import re
 import collections
-import subprocess
-import pathlib
+import types
+import functools
+import itertools
+import operator
+import numbers
+import importlib
+import threading
+import marshal
+import zlib
+from six.moves import queue
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 SHORTAPPNAME = "tse"
 LOGAPPNAME = "Text Stream Editor in Python"
+VERSION = "0.1.0"
 SCRIPTFILE = os.path.join(os.path.expanduser(u"~"), ".tserc")
+CACHEDIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser(u"~"), ".cache"),
+    "tse")
+
+# Maximum total size of cached code objects.
+CACHE_SIZE = 4 * 1024 * 1024
 
 PY3 = sys.version_info[0] == 3
 
+BUFFER_SIZE = 1024 * 1024
+
+# Size of the first block of files read to detect binary files.
+SNIFF_SIZE = 8192
+
+# Seconds to wait for FILEs to grow with --follow.
+FOLLOW_INTERVAL = 1.0
+
+# Default memory used to sort output before spilling to temporary files.
+SORT_MEMORY = 256 * 1024 * 1024
+
+# Maximum number of temporary files merged at once.
+MERGE_WIDTH = 64
+
+# Extensions, magic number and module of compressed files.
+COMPRESSIONS = [
+    (('.gz',), b'\x1f\x8b', 'gzip'),
+    (('.bz2',), b'BZh', 'bz2'),
+    (('.xz', '.lzma'), b'\xfd7zXZ\x00', 'lzma'),
+]
+
+# Categories of regex which never match to newline.
+SAFE_CATEGORIES = frozenset(
+    ['CATEGORY_DIGIT', 'CATEGORY_WORD', 'CATEGORY_NOT_SPACE', 'CATEGORY_NOT_LINEBREAK'])
+
+# Names which allow an action to read variables that can not be found in
+# its code object.
+DYNAMIC_NAMES = frozenset(['eval', 'exec', 'locals', 'vars', 'globals'])
+
+# Names defined by tse other than modules imported by "from glob import *"
+# and "from pathlib import *".
+NAMESPACE_NAMES = frozenset([
+    'sys', 'os', 're', 'path', 'P', 'E', 'S', 'M', 'L', 'L0', 'N', 'LINENO',
+    'FILENAME', 'F', 'STOP', 'LINES', 'LINENOS', 'FIELDS'])
+# Names exported by tse.aggregate.
+AGGREGATE_NAMES = frozenset(['Count', 'TopK', 'Quantiles', 'Distinct'])
+RE_LINE_VAR = re.compile(r'[SL]\d+$')
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def _function_names(code):
+    # names referred by functions and classes defined in the code.
+    names = set()
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            if not const.co_name.startswith('<'):
+                names |= _code_names(const)
+            names |= _function_names(const)
+    return names
+
+
+def _stored_names(code):
+    import dis
+    return [i.argval for i in dis.get_instructions(code)
+            if i.opname in ('STORE_NAME', 'STORE_GLOBAL')]
+
+
+def _compression(filename):
+    """Returns name of module to read the compressed file, or None."""
+    ext = os.path.splitext(filename)[1].lower()
+    for exts, magic, module in COMPRESSIONS:
+        if ext in exts:
+            return module
+
+    # Only regular files are sniffed, since reading from pipes such as
+    # /dev/stdin or <(cmd) would consume the input.
+    try:
+        if not stat.S_ISREG(os.stat(filename).st_mode):
+            return None
+        with open(filename, 'rb') as f:
+            head = f.read(8)
+    except (IOError, OSError):
+        return None
+    for exts, magic, module in COMPRESSIONS:
+        if head.startswith(magic):
+            return module
+    return None
+
+
+def _line_safe(regex):
+    """Returns True if the regex never matches across lines."""
+    try:
+        tree = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return False
+    return _subpattern_line_safe(tree, bool(regex.flags & re.S))
+
+
+def _subpattern_line_safe(pattern, dotall):
+    for op, av in pattern:
+        op = str(op)
+        if op == 'LITERAL':
+            if av == 10:
+                return False
+        elif op == 'ANY':
+            if dotall:
+                return False
+        elif op == 'IN':
+            for op_in, av_in in av:
+                op_in = str(op_in)
+                if op_in == 'LITERAL':
+                    if av_in == 10:
+                        return False
+                elif op_in == 'RANGE':
+                    if av_in[0] <= 10 <= av_in[1]:
+                        return False
+                elif op_in == 'CATEGORY':
+                    if str(av_in) not in SAFE_CATEGORIES:
+                        return False
+                else:
+                    return False
+        elif op == 'AT':
+            if str(av) not in ('AT_BEGINNING', 'AT_END', 'AT_BOUNDARY', 'AT_NON_BOUNDARY'):
+                return False
+        elif op == 'SUBPATTERN':
+            group, add_flags, del_flags, p = av
+            if add_flags & re.S:
+                dotall = True
+            if del_flags & re.S:
+                dotall = False
+            if not _subpattern_line_safe(p, dotall):
+                return False
+        elif op in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT'):
+            if not _subpattern_line_safe(av[2], dotall):
+                return False
+        elif op == 'BRANCH':
+            if not all(_subpattern_line_safe(p, dotall) for p in av[1]):
+                return False
+        elif op == 'ATOMIC_GROUP':
+            if not _subpattern_line_safe(av, dotall):
+                return False
+        elif op in ('ASSERT', 'ASSERT_NOT'):
+            # Look behind may see the preceding line.
+            direction, p = av
+            if direction < 0 or not _subpattern_line_safe(p, dotall):
+                return False
+        elif op == 'GROUPREF':
+            pass
+        else:
+            return False
+    return True
+
+
+def _literal(regex):
+    """Returns the string matched by the regex if the regex matches only
+    the string, or None."""
+    try:
+        tree = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+    if not len(tree) or regex.flags & re.I:
+        return None
+    if any(str(op) != 'LITERAL' for op, av in tree):
+        return None
+    if isinstance(regex.pattern, bytes):
+        return bytes(av for op, av in tree)
+    return u''.join(six.unichr(av) for op, av in tree)
+
+
+class _LineFeeder(object):
+    """Iterator which returns a line once to feed csv.reader."""
+
+    line = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line, self.line = self.line, None
+        if line is None:
+            raise StopIteration
+        return line
+
+    next = __next__
+
+
+def _csv_splitter(dialect):
+    import csv
+    feeder = _LineFeeder()
+    reader = csv.reader(feeder, dialect)
+
+    def split(line):
+        feeder.line = line
+        for fields in reader:
+            return fields
+        return []
+    return split
+
+
+def _fixed_splitter(widths):
+    columns = []
+    pos = 0
+    for width in widths:
+        columns.append((pos, pos + width))
+        pos += width
+
+    def split(line):
+        size = len(line)
+        return [line[start:end] for start, end in columns if start < size]
+    return split
+
+
 def _split_modules(modules):
     modules = modules or ()
     ret = []
@@ -30,6 +264,86 @@ def _split_modules(modules):
         ret.extend(modules)
     return ret
 
+
+class CodeCache:
+    """Marshalled code objects stored in files under CACHEDIR.
+
+    Entries are keyed by their sources, options and the version of Python.
+    Files are named after checksums of the keys, and the keys are stored in
+    the files to detect collisions. Least recently used entries are removed
+    when the total size exceeds CACHE_SIZE. Errors in reading or writing
+    cache files are ignored.
+    """
+
+    def __init__(self, dirname=None, maxsize=None):
+        self.dirname = dirname or CACHEDIR
+        self.maxsize = CACHE_SIZE if maxsize is None else maxsize
+
+    def key(self, *args):
+        return repr((VERSION, sys.version, args))
+
+    def filename(self, key):
+        # hashlib is not used since importing it takes longer than
+        # compiling small actions.
+        b = key.encode('utf-8')
+        return os.path.join(self.dirname, '%08x%08x' % (zlib.crc32(b), zlib.adler32(b)))
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                stored, value = marshal.load(f)
+                mtime = os.fstat(f.fileno()).st_mtime
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if stored != key:
+            return None
+
+        # Mark as recently used. Entries used within a minute are not
+        # touched to save a system call.
+        if time.time() - mtime > 60:
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass
+        return value
+
+    def set(self, key, value):
+        filename = self.filename(key)
+        tmpname = '%s.%s' % (filename, os.getpid())
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname)
+            with open(tmpname, 'wb') as f:
+                marshal.dump((key, value), f)
+            os.replace(tmpname, filename)
+            self.evict()
+        except (IOError, OSError, ValueError):
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.dirname):
+            try:
+                st = os.stat(os.path.join(self.dirname, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.unlink(os.path.join(self.dirname, name))
+            except OSError:
+                pass
+            total -= size
+
+
 class Env:
     exec_actions = ()
     actions = ()
@@ -39,24 +353,111 @@ class Env:
     inputerrors = outputerrors = 'strict'
     encoding = locale.getpreferredencoding()
     scriptfile = SCRIPTFILE
+    shared_names = frozenset()
+    action_sources = ()
+    _loop = None
+    dispatch = None
+    scanner = None
+    begin_names = ()
 
     def __init__(self, execute, statement, begin, end, input_encoding, output_encoding,
-                 module, module_star, script_file, inplace, ignore_case, field_separator, files):
+                 module, module_star, script_file, inplace, ignore_case, field_separator, files,
+                 compile_loop=False, jobs=None, unordered=False, chunk_size=None,
+                 bytes_mode=False, scan=False, buffer_size=None, line_buffered=False,
+                 verbose=False, cache=False, startup_profile=False, stats=False,
+                 profile=None, command_jobs=None, command_timeout=None, command_cache=None,
+                 field_format=None, widths=None, record_separator=None,
+                 max_count=None, max_count_per_file=None, batch=None,
+                 recursive=False, include=None, exclude=None, gitignore=False,
+                 follow=False, state=None, sort_key=None, uniq=False, uniq_count=False,
+                 sort_memory=None):
+        self._args = (execute, statement, begin, end, input_encoding, output_encoding,
+                      module, module_star, script_file, inplace, ignore_case,
+                      field_separator, files)
+        self._kwargs = dict(compile_loop=compile_loop, jobs=jobs, unordered=unordered,
+                            chunk_size=chunk_size, bytes_mode=bytes_mode, scan=scan,
+                            buffer_size=buffer_size, line_buffered=line_buffered,
+                            verbose=verbose, cache=cache,
+                            startup_profile=startup_profile, stats=stats,
+                            profile=profile, command_jobs=command_jobs,
+                            command_timeout=command_timeout, command_cache=command_cache,
+                            field_format=field_format, widths=widths,
+                            record_separator=record_separator, max_count=max_count,
+                            max_count_per_file=max_count_per_file, batch=batch,
+                            recursive=recursive, include=include, exclude=exclude,
+                            gitignore=gitignore, follow=follow, state=state,
+                            sort_key=sort_key, uniq=uniq, uniq_count=uniq_count,
+                            sort_memory=sort_memory)
+
         self.ignore_case = ignore_case
+        self.compile_loop = compile_loop
+        self.jobs = jobs
+        self.unordered = unordered
+        self.chunk_size = chunk_size
+        self.bytes_mode = bytes_mode
+        self.newline = b'\n' if bytes_mode else u'\n'
+        self.buffer_size = buffer_size
+        self.line_buffered = line_buffered
+        self.verbose = verbose
+        self.startup_profile = startup_profile
+        self.stats = stats
+        self.profile = profile
+        self.command_jobs = command_jobs
+        self.command_timeout = command_timeout
+        self.command_cache = command_cache
         self.field_separator = field_separator
+        self.field_format = field_format
+        self.widths = widths
+        self.record_separator = record_separator
+        self.max_count = max_count
+        self.max_count_per_file = max_count_per_file
+        self.batch = batch
+        self.recursive = recursive
+        self.include = include or ()
+        self.exclude = exclude or ()
+        self.gitignore = gitignore
+        self.follow = follow
+        self.state = state
+        self.sort_key = sort_key
+        self.sortcode = None
+        if sort_key:
+            self.sortcode = compile('lambda L: (%s)' % sort_key, '<sort>', 'eval')
+        self.uniq = uniq
+        self.uniq_count = uniq_count
+        self.sort_memory = sort_memory
+        self.cache = CodeCache() if cache else None
+
+        # Code objects of the actions are cached as a dict of
+        # {(isbody, codes): (source, code)}.
+        self.compiled = {}
+        cachekey = None
+        if self.cache and (execute or statement or begin or end):
+            cachekey = self.cache.key('actions', execute, statement, begin, end,
+                                      bytes_mode, bool(batch), self.encoding)
+            cached = self.cache.get(cachekey)
+            if isinstance(cached, dict):
+                self.compiled = cached
+        ncompiled = len(self.compiled)
 
         if execute:
             self.exec_actions = self.build_code(False, (s for b in execute for s in b))
 
         if statement:
-            self.actions = [(self.build_re(r), self.build_code(True, c))
-                            for (r, c) in self._parse_statement(statement)]
+            statements = list(self._parse_statement(statement))
+            compiled = [self.build_action(True, c) for (r, c) in statements]
+            self.action_sources = [source for source, code in compiled]
+            self.actions = [(self.build_re(r), code)
+                            for ((r, c), (source, code)) in zip(statements, compiled)]
 
         if begin:
             self.begincode = self.build_code(False, (s for b in begin for s in b))
+            self.begin_names = _stored_names(self.begincode)
         if end:
             self.endcode = self.build_code(False, (s for e in end for s in e))
 
+        if cachekey and len(self.compiled) != ncompiled:
+            self.cache.set(cachekey, self.compiled)
+
         if input_encoding:
             enc, _, errors = (s.strip() for s in input_encoding.partition(':'))
             if enc:
@@ -80,6 +481,34 @@ class Env:
         self.imports_star = _split_modules(module_star)
 
         self.files = files or ()
+        if recursive and not self.files:
+            self.files = ['.']
+
+        self.dispatch = self.build_dispatcher()
+        # Scanner reads ahead of lines, so the rest of the file can not be
+        # copied if --inplace is stopped, nor the offset of the last line
+        # can be saved to --state.
+        if scan and record_separator is None and not inplace and not follow and not state:
+            self.scanner = self.build_scanner()
+
+        # Variables read by the codes other than the action itself must
+        # always be bound.
+        shared = set()
+        for code in (self.exec_actions, self.begincode, self.endcode):
+            if code:
+                shared |= _code_names(code)
+        for r, code in self.actions:
+            shared |= _function_names(code)
+        self.shared_names = frozenset(shared)
+
+    # Code objects can not be pickled. Env is re-built from the arguments
+    # to be passed to worker processes.
+    def __getstate__(self):
+        return self._args, self._kwargs
+
+    def __setstate__(self, state):
+        args, kwargs = state
+        self.__init__(*args, **kwargs)
 
     def _parse_statement(self, statement):
         pattern = None
@@ -112,9 +541,374 @@ class Env:
     def build_re(self, regex):
         if not regex:
             regex = '.*'
+        if self.bytes_mode:
+            regex = os.fsencode(regex)
         flags = re.I if self.ignore_case else 0
         return re.compile(regex, flags)
 
+    def build_fs(self):
+        """Returns a function to split a line into fields, or None if
+        fields are separated by whitespace."""
+        if self.field_format:
+            return _csv_splitter('excel-tab' if self.field_format == 'tsv' else 'excel')
+        if self.widths:
+            return _fixed_splitter(self.widths)
+        if not self.field_separator:
+            return None
+
+        if self.bytes_mode:
+            regex = re.compile(os.fsencode(self.field_separator))
+        else:
+            regex = re.compile(self.field_separator)
+        literal = _literal(regex)
+        if literal:
+            return lambda line: line.split(literal)
+        return regex.split
+
+    def build_reader(self):
+        """Returns a function to iterate records of an input separated by
+        ``--record-separator``."""
+        separator = self.record_separator
+        if self.bytes_mode:
+            separator = os.fsencode(separator)
+        if not separator:
+            # Paragraph mode.
+            separator = br'\n\n+' if self.bytes_mode else r'\n\n+'
+            return functools.partial(RecordReader, separator=re.compile(separator),
+                                     paragraph=True)
+
+        regex = re.compile(separator)
+        return functools.partial(RecordReader, separator=_literal(regex) or regex)
+
+    def iter_files(self):
+        """Yields FILEs to read. Directories are walked if --recursive is
+        specified."""
+        for f in self.files:
+            if self.recursive and os.path.isdir(f):
+                for path in _walk(self, f):
+                    yield path
+            else:
+                yield f
+
+    def open_input(self, filename=None):
+        """Open a file to read, or standard input if filename is None.
+
+        Iterating the file yields records if --record-separator is
+        specified.
+        """
+        stream = self._open_input(filename)
+        if self.record_separator is not None:
+            return self.build_reader()(stream)
+        return stream
+
+    def _open_input(self, filename):
+        if filename is None:
+            if six.PY2:
+                return codecs.getreader(self.inputenc)(sys.stdin, self.inputerrors)
+            fd = os.dup(sys.stdin.buffer.fileno())
+            if self.bytes_mode:
+                return io.open(fd, 'rb', buffering=BUFFER_SIZE)
+            return io.open(fd, encoding=self.inputenc, errors=self.inputerrors)
+
+        compression = _compression(filename)
+        if compression:
+            stream = importlib.import_module(compression).open(filename, 'rb')
+            if not self.bytes_mode:
+                stream = io.TextIOWrapper(stream, encoding=self.inputenc,
+                                          errors=self.inputerrors)
+            return ReadAheadReader(stream, self.newline)
+
+        if self.bytes_mode:
+            return io.open(filename, 'rb', buffering=BUFFER_SIZE)
+        return io.open(filename, 'r', encoding=self.inputenc, errors=self.inputerrors)
+
+    def open_log(self, filename):
+        """Open a file to read lines appended since the last run."""
+        if _compression(filename):
+            raise ValueError('%s: compressed file can not be read incrementally' % filename)
+        if self.bytes_mode:
+            return LogReader(filename)
+        return LogReader(filename, self.inputenc, self.inputerrors)
+
+    def open_sorter(self, output, globals):
+        """Returns a stream to sort lines written before writing them to
+        output, or None if --sort, --uniq and --uniq-count are not
+        specified."""
+        if self.sort_key is None and not self.uniq and not self.uniq_count:
+            return None
+        key = eval(self.sortcode, globals) if self.sortcode else None
+        return SortedOutput(output, key, uniq=self.uniq, count=self.uniq_count,
+                            memory=self.sort_memory, bytes_mode=self.bytes_mode)
+
+    def open_output(self, filename=None, stats=None):
+        """Open a file to write, or standard output if filename is None.
+
+        Written bytes are counted in ``stats.output`` if stats is given.
+        """
+        if six.PY2:
+            writer = codecs.getwriter(self.outputenc)
+            writer.encoding = self.outputenc
+            if filename is None:
+                return writer(sys.stdout, self.outputerrors)
+            return writer(open(filename, 'w'), self.outputerrors)
+
+        if filename is None:
+            if not hasattr(sys.stdout, 'buffer'):
+                return sys.stdout
+            filename = os.dup(sys.stdout.buffer.fileno())
+
+        raw = io.open(filename, 'wb', buffering=0)
+        line_buffering = self.line_buffered or raw.isatty()
+        if stats is not None:
+            raw = WriteCounter(raw, stats)
+        if not line_buffering:
+            raw = AsyncWriter(raw)
+        buffer = io.BufferedWriter(raw, self.buffer_size or BUFFER_SIZE)
+        return io.TextIOWrapper(buffer, encoding=self.outputenc, errors=self.outputerrors,
+                                line_buffering=line_buffering,
+                                # Actions write bytes to the buffer directly in
+                                # --bytes mode, so text must not be kept in the
+                                # wrapper.
+                                write_through=self.bytes_mode)
+
+    # Patterns which refer groups by number can not be combined.
+    RE_UNSAFE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    def _combine_re(self, regexes, flags=0):
+        if len(regexes) == 1:
+            return re.compile(regexes[0].pattern, regexes[0].flags | flags)
+
+        if regexes[0].flags & re.X or any(r.flags != regexes[0].flags for r in regexes):
+            return None
+        if any(self.RE_UNSAFE.search(os.fsdecode(r.pattern)) for r in regexes):
+            return None
+
+        try:
+            if self.bytes_mode:
+                pattern = b'|'.join(b'(?:' + r.pattern + b')' for r in regexes)
+            else:
+                pattern = '|'.join('(?:%s)' % r.pattern for r in regexes)
+            return re.compile(pattern, regexes[0].flags | flags)
+        except re.error:
+            return None
+
+    def build_dispatcher(self):
+        """Combine patterns of statements into a regex to find lines
+        matched to any statement with a scan.
+
+        Returns a function which returns a tuple of index of the statement
+        and match object, or None if patterns could not be combined.
+        """
+        regexes = [r for r, c in self.actions]
+        if len(regexes) < 2:
+            return None
+
+        combined = self._combine_re(regexes)
+        if not combined:
+            return None
+
+        search = combined.search
+        searches = list(enumerate(r.search for r in regexes))
+
+        def dispatch(line):
+            m = search(line)
+            if m is None:
+                return None
+
+            # No statement matches before the position.
+            pos = m.start()
+            for i, search_statement in searches:
+                m = search_statement(line, pos)
+                if m:
+                    return i, m
+
+        return dispatch
+
+    def build_scanner(self):
+        """Build a function to find lines matched to any statement by
+        searching large blocks of input.
+
+        The function yields tuples of line number and line. Returns None if
+        a pattern may match across lines.
+        """
+        regexes = [r for r, c in self.actions]
+        if not regexes or not all(_line_safe(r) for r in regexes):
+            return None
+
+        # ^ and $ should match at the beginning and end of lines.
+        combined = self._combine_re(regexes, re.M)
+        if not combined:
+            return None
+
+        search = combined.search
+        newline = self.newline
+
+        def scan(input, lineno=1):
+            while True:
+                buf = input.read(BUFFER_SIZE)
+                if not buf:
+                    return
+                if not buf.endswith(newline):
+                    buf += input.readline()
+
+                # lineno is the line number of the line starts at pos. pos
+                # exceeds len(buf) after the last line without a newline.
+                pos = 0
+                while pos <= len(buf):
+                    m = search(buf, pos)
+                    if not m:
+                        break
+                    hit = m.start()
+                    if hit == len(buf) and buf.endswith(newline):
+                        break
+
+                    start = buf.rfind(newline, 0, hit) + 1
+                    end = buf.find(newline, hit)
+                    if end == -1:
+                        end = len(buf)
+
+                    lineno += buf.count(newline, pos, start)
+                    yield lineno, buf[start:end]
+                    pos = end + 1
+                    lineno += 1
+
+                lineno += buf.count(newline, pos)
+
+        return scan
+
+    def build_script(self):
+        if not self.scriptfile:
+            return None
+        try:
+            with open(self.scriptfile, "r") as f:
+                script = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except IOError:
+            return None
+
+        if not script:
+            return None
+
+        key = None
+        code = None
+        if self.cache:
+            key = self.cache.key('script', self.scriptfile, mtime, script)
+            code = self.cache.get(key)
+        if not isinstance(code, types.CodeType):
+            code = compile(script + "\n", self.scriptfile, "exec")
+            if key:
+                self.cache.set(key, code)
+
+        self.shared_names = self.shared_names | _code_names(code)
+        return code
+
+    def build_bindings(self, regex, code, fs):
+        if self.shared_names & DYNAMIC_NAMES:
+            return Bindings(regex, None, fs)
+
+        names = _code_names(code)
+        bindings = Bindings(regex, names | self.shared_names, fs)
+        if names & DYNAMIC_NAMES:
+            bindings.lazy = Bindings(regex, None, fs)
+        return bindings
+
+    def build_loop(self, globals):
+        """Compile all statements into a function to process an input.
+
+        Returns None if statements could not be compiled into a function.
+        """
+        # The loop is bound to globals. Read once, since other threads may
+        # build loops for other globals.
+        cached = self._loop
+        if cached and cached[0] is globals:
+            return cached[1]
+
+        loop = None
+        if PY3 and self.actions:
+            try:
+                loop = self._build_loop(globals)
+            except SyntaxError:
+                pass
+        self._loop = (globals, loop)
+        return loop
+
+    def _build_loop(self, globals):
+        # Errors of AsyncWriter are checked at every matched line.
+        output = globals.get('__tse_output')
+        bindings = [self.build_bindings(r, c, None) for r, c in self.actions]
+        if any(b.lazy or b.fields is None for b in bindings):
+            return None
+
+        localnames = set()
+        for b in bindings:
+            localnames.update(b.names())
+        globalnames = localnames & self.shared_names
+        localnames -= self.shared_names
+
+        for r, c in self.actions:
+            globalnames |= _code_names(c)
+        globalnames -= localnames
+
+        params = ['__tse_lines', '__tse_filename', '__tse_split', '__tse_path',
+                  '__tse_dispatch', '__tse_matched', '__tse_output']
+        params.extend('__tse_search%d' % i for i in range(len(self.actions)))
+
+        lines = ['def __tse_loop(%s):' % ', '.join(params)]
+        if globalnames:
+            lines.append('    global %s' % ', '.join(sorted(globalnames)))
+        lines.append('    for __tse_lineno, __tse_line in __tse_lines:')
+        lines.append('        __tse_line = __tse_line.rstrip(%r)' % self.newline)
+        if self.dispatch:
+            lines.append('        __tse_found = __tse_dispatch(__tse_line)')
+            lines.append('        if __tse_found is None:')
+            lines.append('            continue')
+            lines.append('        __tse_i, __tse_m = __tse_found')
+        for i, b in enumerate(bindings):
+            if self.dispatch:
+                lines.append('        if __tse_i == %d:' % i)
+            else:
+                lines.append('        __tse_m = __tse_search%d(__tse_line)' % i)
+                lines.append('        if __tse_m:')
+            lines.extend('            ' + line for line in b.source())
+            lines.append('            __tse_action%d' % i)
+            if self.max_count or self.max_count_per_file:
+                lines.append('            __tse_matched()')
+            if output:
+                lines.append('            if __tse_output.error is not None:')
+                lines.append('                __tse_output.check()')
+            lines.append('            continue')
+
+        import ast
+        tree = ast.parse('\n'.join(lines), u"<tse>")
+        actions = [ast.parse(source, u"<tse>").body for source in self.action_sources]
+
+        class _Transform(ast.NodeTransformer):
+
+            def visit_Expr(self, node):
+                if isinstance(node.value, ast.Name) and node.value.id.startswith('__tse_action'):
+                    return actions[int(node.value.id[len('__tse_action'):])]
+                return node
+
+        tree = ast.fix_missing_locations(_Transform().visit(tree))
+        code = compile(tree, u"<tse>", "exec")
+        func = types.FunctionType(
+            [c for c in code.co_consts if isinstance(c, types.CodeType)][0], globals)
+
+        split = self.build_fs()
+        if not split:
+            split = bytes.split if self.bytes_mode else six.text_type.split
+        searches = [r.search for r, c in self.actions]
+        needpath = any(b.F for b in bindings)
+
+        if needpath:
+            import pathlib
+
+        def loop(lines, filename, matched=None):
+            path = pathlib.Path(filename) if needpath else None
+            func(lines, filename, split, path, self.dispatch, matched, output, *searches)
+
+        return loop
+
     RE_INDENT = re.compile(r'{{}}|{{|}}')
     RE_TOKEN = re.compile(r'([fFrR]*`|"""|\'\'\'|"|\')|#')
 
@@ -133,6 +927,18 @@ class Env:
             return '\n' + ' ' * self.indent
 
     def build_code(self, isbody, codes):
+        return self.build_action(isbody, codes)[1]
+
+    def build_action(self, isbody, codes):
+        """Returns a tuple of the translated source and the code object."""
+
+        key = (isbody, tuple(codes))
+        if key not in self.compiled:
+            source = self.build_source(isbody, key[1])
+            self.compiled[key] = (source, self.compile_source(source))
+        return self.compiled[key]
+
+    def build_source(self, isbody, codes):
         converted = []
         indent = self.sub_indent()
         for code in codes:
@@ -181,8 +987,14 @@ class Env:
 
         result = "\n".join(converted)
         if isbody and (not result.strip()):
-            result = 'print(L)'
-        
+            # L is not bound in --batch mode.
+            if self.batch:
+                result = "P(b'\\n'.join(LINES))" if self.bytes_mode else "print(*LINES, sep='\\n')"
+            else:
+                result = 'P(L)' if self.bytes_mode else 'print(L)'
+        return result
+
+    def compile_source(self, result):
         filename = u"<tse>"
         if six.PY3:
             return compile(result, filename, "exec")
@@ -190,6 +1002,7 @@ class Env:
         if not result:
             return None
 
+        import ast
         enc = self.encoding
 
         class _Transform(ast.NodeTransformer):
@@ -216,73 +1029,735 @@ class VarnameDict(collections.defaultdict):
         return ret
 
 
-def _run_script(env, input, filename, globals, locals):
-    fs = re.compile(env.field_separator) if env.field_separator else None
+class Bindings:
+    """Binds the variables of the current line an action refers to.
+
+    If ``names`` is None, all the variables are bound. If ``lazy`` is set,
+    variables not in ``names`` are evaluated on access through
+    :class:`LazyLocals`.
+    """
+
+    RE_GROUP_VAR = re.compile(r'S(\d+)$')
+    RE_FIELD_VAR = re.compile(r'L(\d+)$')
+
+    lazy = None
+
+    def __init__(self, regex, names, fs):
+        self.fs = fs
+        self.filename = self.path = None
+
+        if names is None:
+            self.S = self.M = self.L = self.L0 = self.N = True
+            self.LINENO = self.FILENAME = self.F = True
+            self.groups = [(n, 'S%d' % n) for n in range(regex.groups + 1)]
+            self.named = list(regex.groupindex)
+            self.fields = None
+            self.split = True
+            return
+
+        self.S = 'S' in names
+        self.M = 'M' in names
+        self.L = 'L' in names
+        self.L0 = 'L0' in names
+        self.N = 'N' in names
+        self.LINENO = 'LINENO' in names
+        self.FILENAME = 'FILENAME' in names
+        self.F = 'F' in names
+
+        self.groups = []
+        self.fields = []
+        for name in sorted(names):
+            m = self.RE_GROUP_VAR.match(name)
+            if m and int(m.group(1)) <= regex.groups:
+                self.groups.append((int(m.group(1)), name))
+            m = self.RE_FIELD_VAR.match(name)
+            if m and int(m.group(1)):
+                self.fields.append((int(m.group(1)), name))
+
+        self.named = [name for name in regex.groupindex if name in names]
+        self.split = bool(self.L0 or self.N or self.fields)
+
+    def bind(self, locals, m, line, lineno, filename):
+        if self.S:
+            locals['S'] = (m.group(),) + m.groups()
+        for n, name in self.groups:
+            locals[name] = m.group(n)
+        for name in self.named:
+            locals[name] = m.group(name)
+        if self.M:
+            locals['M'] = m
+
+        if self.L:
+            locals['L'] = line
+
+        if self.split:
+            if self.fs:
+                fields = self.fs(line)
+            else:
+                fields = line.split()
 
-    FIELD_VARS = VarnameDict('L')
-    GROUP_VARS = VarnameDict('S')
+            if self.L0:
+                locals['L0'] = fields
+            if self.fields is None:
+                for n, s in enumerate(fields, 1):
+                    locals[FIELD_VARS[n]] = s
+            else:
+                nfields = len(fields)
+                for n, name in self.fields:
+                    if n <= nfields:
+                        locals[name] = fields[n - 1]
+            if self.N:
+                locals['N'] = len(fields)
+
+        if self.LINENO:
+            locals['LINENO'] = lineno
+        if self.FILENAME:
+            locals['FILENAME'] = filename
+        if self.F:
+            if filename != self.filename:
+                import pathlib
+                self.filename = filename
+                self.path = pathlib.Path(filename)
+            locals['F'] = self.path
+
+    def names(self):
+        ret = [name for flag, name in (
+            (self.S, 'S'), (self.M, 'M'), (self.L, 'L'), (self.L0, 'L0'), (self.N, 'N'),
+            (self.LINENO, 'LINENO'), (self.FILENAME, 'FILENAME'), (self.F, 'F')) if flag]
+        ret.extend(name for n, name in self.groups)
+        ret.extend(self.named)
+        ret.extend(name for n, name in self.fields)
+        return ret
 
-    for lineno, line in enumerate(input, 1):
-        line = line.rstrip(u"\n")
-        for r, c in env.actions:
+    def source(self):
+        """Python statements to bind variables in the compiled loop."""
+        ret = []
+        if self.S:
+            ret.append('S = (__tse_m.group(),) + __tse_m.groups()')
+        for n, name in self.groups:
+            ret.append('%s = __tse_m.group(%d)' % (name, n))
+        for name in self.named:
+            ret.append('%s = __tse_m.group(%r)' % (name, name))
+        if self.M:
+            ret.append('M = __tse_m')
+        if self.L:
+            ret.append('L = __tse_line')
+        if self.split:
+            ret.append('__tse_fields = __tse_split(__tse_line)')
+            if self.L0:
+                ret.append('L0 = __tse_fields')
+            for n, name in self.fields:
+                ret.append('if len(__tse_fields) >= %d: %s = __tse_fields[%d]' % (n, name, n - 1))
+            if self.N:
+                ret.append('N = len(__tse_fields)')
+        if self.LINENO:
+            ret.append('LINENO = __tse_lineno')
+        if self.FILENAME:
+            ret.append('FILENAME = __tse_filename')
+        if self.F:
+            ret.append('F = __tse_path')
+        return ret
+
+    def namespace(self, locals, m, line, lineno, filename):
+        if not self.lazy:
+            return locals
+        return LazyLocals(locals, self.lazy, m, line, lineno, filename)
+
+
+class LazyLocals(MutableMapping):
+    """Namespace to evaluate variables of the current line on access.
+
+    Assignments are stored to the underlying dictionary.
+    """
+
+    FIXED_NAMES = frozenset(
+        ['S', 'M', 'L', 'L0', 'N', 'LINENO', 'FILENAME', 'F'])
+    RE_VAR = re.compile(r'[SL]\d+$')
+
+    def __init__(self, locals, bindings, m, line, lineno, filename):
+        self._locals = locals
+        self._bindings = bindings
+        self._args = (m, line, lineno, filename)
+        self._vars = None
+        self._assigned = set()
+
+    def _getvars(self):
+        if self._vars is None:
+            self._vars = {}
+            self._bindings.bind(self._vars, *self._args)
+        return self._vars
+
+    def _isvar(self, key):
+        if key in self._assigned:
+            return False
+        return (key in self.FIXED_NAMES or key in self._args[0].re.groupindex
+                or bool(self.RE_VAR.match(key)))
+
+    def __getitem__(self, key):
+        if self._isvar(key):
+            vars = self._getvars()
+            if key in vars:
+                return vars[key]
+        return self._locals[key]
+
+    def __setitem__(self, key, value):
+        self._assigned.add(key)
+        self._locals[key] = value
+
+    def __delitem__(self, key):
+        self._assigned.add(key)
+        del self._locals[key]
+
+    def __iter__(self):
+        vars = self._getvars()
+        for key in vars:
+            if key not in self._assigned:
+                yield key
+        for key in self._locals:
+            if key not in vars or key in self._assigned:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+FIELD_VARS = VarnameDict('L')
+
+
+def _run_script(env, input, filename, globals, locals, lineno=1, stats=None):
+    if env.scanner:
+        lines = env.scanner(input, lineno)
+    else:
+        lines = enumerate(input, lineno)
+
+    # Called at every matched line to stop at --max-count.
+    matched = None
+    counter = globals.get('__tse_counter')
+    if counter:
+        matched = counter.start()
+
+    if env.compile_loop and not env.batch and stats is None:
+        loop = env.build_loop(globals)
+        if loop:
+            loop(lines, filename, matched)
+            return
+
+    # A closed pipe stops reading at the next matched line, without waiting
+    # for the output buffer to be filled.
+    output = globals.get('__tse_output')
+    if output is not None:
+        matched = _checked(output, matched)
+
+    if env.batch:
+        _run_script_batch(env, lines, filename, globals, locals, matched)
+        return
+
+    if stats is not None:
+        _run_script_stats(env, lines, filename, globals, locals, stats, matched)
+        return
+
+    fs = env.build_fs()
+    newline = env.newline
+    actions = [(r, c, env.build_bindings(r, c, fs)) for r, c in env.actions]
+
+    dispatch = env.dispatch
+    if dispatch:
+        for lineno, line in lines:
+            line = line.rstrip(newline)
+            found = dispatch(line)
+            if found:
+                i, m = found
+                r, c, bindings = actions[i]
+                bindings.bind(locals, m, line, lineno, filename)
+                six.exec_(c, globals, bindings.namespace(
+                    locals, m, line, lineno, filename))
+                if matched:
+                    matched()
+        return
+
+    for lineno, line in lines:
+        line = line.rstrip(newline)
+        for r, c, bindings in actions:
             m = r.search(line)
             if m:
-                S = (m.group(),) + m.groups()
-                locals['S'] = S
-                for n, s in enumerate(S):
-                    locals[GROUP_VARS[n]] = s
-                for k, v in m.groupdict().items():
-                    locals[k] = v
-                locals['M'] = m
-
-                locals['L'] = line
-
-                if fs:
-                    locals['L0'] = fs.split(line)
+                bindings.bind(locals, m, line, lineno, filename)
+                six.exec_(c, globals, bindings.namespace(
+                    locals, m, line, lineno, filename))
+                if matched:
+                    matched()
+                break
+
+
+def _checked(output, matched=None):
+    def checked():
+        if output.error is not None:
+            output.check()
+        if matched:
+            matched()
+    return checked
+
+
+def _run_script_stats(env, lines, filename, globals, locals, stats, matched=None):
+    # Same as the plain loop of _run_script, but measures each step.
+    # Patterns are searched one by one to count lines tested by each
+    # statement.
+    fs = env.build_fs()
+    newline = env.newline
+    actions = [(i, r, c, env.build_bindings(r, c, fs)) for i, (r, c) in enumerate(env.actions)]
+    clock = time.perf_counter
+    tested, nmatched = stats.tested, stats.matched
+    search, bind, execute = stats.search, stats.bind, stats.execute
+
+    nlines = size = 0
+    start = clock()
+    try:
+        for lineno, line in lines:
+            nlines += 1
+            size += len(line)
+            line = line.rstrip(newline)
+            for i, r, c, bindings in actions:
+                t0 = clock()
+                m = r.search(line)
+                t1 = clock()
+                tested[i] += 1
+                search[i] += t1 - t0
+                if m:
+                    nmatched[i] += 1
+                    bindings.bind(locals, m, line, lineno, filename)
+                    t2 = clock()
+                    six.exec_(c, globals, bindings.namespace(
+                        locals, m, line, lineno, filename))
+                    bind[i] += t2 - t1
+                    execute[i] += clock() - t2
+                    if matched:
+                        matched()
+                    break
+    finally:
+        stats.files.append((filename, nlines, size, clock() - start))
+
+
+def _run_script_batch(env, lines, filename, globals, locals, matched=None):
+    # Lines are routed to the first matching statement as usual, and the
+    # action is executed for each batch of --batch lines.
+    size = env.batch
+    newline = env.newline
+    split = env.build_fs()
+    if not split:
+        split = bytes.split if env.bytes_mode else six.text_type.split
+    searches = list(enumerate(r.search for r, c in env.actions))
+    dispatch = env.dispatch
+    batches = [([], []) for a in env.actions]
+
+    def run(i):
+        batch_lines, linenos = batches[i]
+        if not batch_lines:
+            return
+        batches[i] = ([], [])
+        locals['LINES'] = batch_lines
+        locals['LINENOS'] = linenos
+        locals['FIELDS'] = Fields(batch_lines, split)
+        locals['FILENAME'] = filename
+        six.exec_(env.actions[i][1], globals, locals)
+
+    try:
+        for lineno, line in lines:
+            line = line.rstrip(newline)
+            if dispatch:
+                found = dispatch(line)
+                if found is None:
+                    continue
+                i = found[0]
+            else:
+                for i, search in searches:
+                    if search(line):
+                        break
                 else:
-                    locals['L0'] = line.split()
+                    continue
+
+            batch_lines, linenos = batches[i]
+            batch_lines.append(line)
+            linenos.append(lineno)
+            if len(batch_lines) >= size:
+                run(i)
+            if matched:
+                matched()
+    except Stop:
+        for i in range(len(batches)):
+            run(i)
+        raise
+
+    for i in range(len(batches)):
+        run(i)
+
+
+class Fields(object):
+    """Columns of fields of ``LINES`` in --batch mode.
+
+    ``FIELDS[n]`` is a list of the n-th field (``Ln``) of each line, or None
+    if the line has less fields. ``FIELDS[0]`` is a list of the fields of
+    each line (``L0``). Lines are split when FIELDS is accessed first.
+    """
+
+    def __init__(self, lines, split):
+        self._lines = lines
+        self._split = split
+        self._rows = None
+
+    def __getitem__(self, n):
+        if self._rows is None:
+            self._rows = [self._split(line) for line in self._lines]
+        if n == 0:
+            return self._rows
+        return [row[n - 1] if len(row) >= n else None for row in self._rows]
+
+    def __len__(self):
+        return len(self._lines)
+
+
+class Stats(object):
+    """Counters reported by --stats."""
+
+    def __init__(self, env):
+        n = len(env.actions)
+        self.patterns = [r.pattern for r, c in env.actions]
+        self.unit = 'bytes' if env.bytes_mode else 'chars'
+        self.tested = [0] * n
+        self.matched = [0] * n
+        self.search = [0.0] * n
+        self.bind = [0.0] * n
+        self.execute = [0.0] * n
+        # List of (filename, lines, size, seconds)
+        self.files = []
+        self.output = 0
+        self.setup = self.elapsed = 0.0
+
+    def merge(self, other):
+        for name in ('tested', 'matched', 'search', 'bind', 'execute'):
+            setattr(self, name, [a + b for a, b in zip(getattr(self, name),
+                                                        getattr(other, name))])
+        self.files.extend(other.files)
+        self.output += other.output
+
+    def report(self, file):
+        write = file.write
+        write('%s: stats: setup %.1fms\n' % (SHORTAPPNAME, self.setup * 1000))
+        for i, pattern in enumerate(self.patterns):
+            write('%s: statement %d %r: tested %d, matched %d, search %.1fms, '
+                  'bind %.1fms, exec %.1fms\n' % (
+                      SHORTAPPNAME, i + 1, pattern, self.tested[i], self.matched[i],
+                      self.search[i] * 1000, self.bind[i] * 1000, self.execute[i] * 1000))
+        for filename, nlines, size, seconds in self.files:
+            write('%s: file %s: %d lines, %d %s, %.1fms\n' % (
+                SHORTAPPNAME, filename, nlines, size, self.unit, seconds * 1000))
+
+        nlines = sum(f[1] for f in self.files)
+        size = sum(f[2] for f in self.files)
+        rate = nlines / self.elapsed if self.elapsed else 0
+        write('%s: total: %d lines, %d %s read, %d bytes written, %.1fms, '
+              '%.0f lines/sec\n' % (SHORTAPPNAME, nlines, size, self.unit, self.output,
+                                    self.elapsed * 1000, rate))
+
+
+class Stop(Exception):
+    """Raised to stop reading input. If ``file`` is true, only the
+    current file is stopped."""
+
+    def __init__(self, file=False):
+        super(Stop, self).__init__(file)
+        self.file = file
+
+
+def STOP(file=False):
+    """Stop processing the input, or the current file if ``file`` is
+    true. --end is executed as usual."""
+    raise Stop(file)
+
+
+class MatchCounter(object):
+    """Counts matched lines for --max-count and --max-count-per-file."""
+
+    def __init__(self, max_count=None, max_count_per_file=None):
+        self.max_count = max_count
+        self.max_count_per_file = max_count_per_file
+        self.total = 0
+        self.count = 0
 
-                for n, s in enumerate(locals['L0'], 1):
-                    locals[FIELD_VARS[n]] = s
+    def start(self):
+        """Start counting lines of a file. Returns a function to be called
+        at each matched line."""
+        self.count = 0
+        return self.matched
 
-                locals['N'] = len(locals['L0'])
-                locals['LINENO'] = lineno
-                locals['FILENAME'] = filename
-                locals['F'] = pathlib.Path(filename)
+    def matched(self):
+        self.total += 1
+        self.count += 1
+        if self.max_count and self.total >= self.max_count:
+            raise Stop()
+        if self.max_count_per_file and self.count >= self.max_count_per_file:
+            raise Stop(file=True)
 
-                six.exec_(c, globals, locals)
 
-                break
+def E(cmd, timeout=None):
+    import subprocess
+    return subprocess.check_output(cmd, shell=True, universal_newlines=True, timeout=timeout)
 
-def E(cmd):
-    return subprocess.check_output(cmd, shell=True, universal_newlines=True)
 
-def run(env):
+class CommandResult(object):
+    """Output of a command run by :class:`CommandPool`.
 
-    locals = globals = {}
+    The output is waited for when the object is used as a string. Methods
+    of str, ``+``, ``*``, ``%`` and indexing return a CommandResult of the
+    result without waiting. ``int()`` and ``float()`` convert the output.
+    Functions which require an actual str, such as ``re.search()`` and
+    ``json.loads()``, should be given ``str(result)`` or ``result.value()``.
+    """
+
+    __slots__ = ('_future',)
+
+    def __init__(self, future):
+        self._future = future
+
+    def value(self):
+        return self._future.result()
+
+    def done(self):
+        return self._future.done()
+
+    def _then(self, func):
+        import concurrent.futures
+        future = concurrent.futures.Future()
+
+        def done(f):
+            try:
+                future.set_result(func(f.result()))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self._future.add_done_callback(done)
+        return CommandResult(future)
+
+    def __getattr__(self, name):
+        if not callable(getattr(six.text_type, name)):
+            return getattr(self.value(), name)
+
+        def method(*args, **kwargs):
+            return self._then(lambda value: getattr(value, name)(*args, **kwargs))
+        return method
+
+    def __str__(self):
+        return six.text_type(self.value())
+
+    def __repr__(self):
+        return repr(self.value())
+
+    def __format__(self, spec):
+        return format(self.value(), spec)
+
+    def __int__(self):
+        return int(self.value())
+
+    __index__ = __int__
+
+    def __float__(self):
+        return float(self.value())
 
-    script = ""
-    if env.scriptfile:
+    def __len__(self):
+        return len(self.value())
+
+    def __iter__(self):
+        return iter(self.value())
+
+    def __contains__(self, s):
+        return s in self.value()
+
+    def __getitem__(self, index):
+        return self._then(lambda value: value[index])
+
+    def __bool__(self):
+        return bool(self.value())
+
+    def __eq__(self, other):
+        return self.value() == other
+
+    def __ne__(self, other):
+        return self.value() != other
+
+    def __lt__(self, other):
+        return self.value() < other
+
+    def __hash__(self):
+        return hash(self.value())
+
+    def __add__(self, other):
+        return self._then(lambda value: value + other)
+
+    def __radd__(self, other):
+        return self._then(lambda value: other + value)
+
+    def __mul__(self, other):
+        return self._then(lambda value: value * other)
+
+    def __mod__(self, other):
+        return self._then(lambda value: value % other)
+
+
+class CommandPool(object):
+    """Runs commands of E() and backticks.
+
+    Outputs of commands are memoized in a LRU cache of ``cache_size``
+    commands. If ``jobs`` is larger than 1, commands are run in threads
+    and E() returns :class:`CommandResult`. print() and P() queue their
+    arguments and write them in order once the commands are completed, so
+    commands of following lines run while waiting.
+    """
+
+    def __init__(self, jobs=1, timeout=None, cache_size=None):
+        self.jobs = jobs
+        self.timeout = timeout
+        self.cache_size = cache_size or 0
+        self.cache = collections.OrderedDict()
+        self.executor = None
+        if jobs > 1:
+            import concurrent.futures
+            self.executor = concurrent.futures.ThreadPoolExecutor(jobs)
+            # Number of commands and writes waiting to be completed.
+            self.window = jobs * 4
+            self.running = threading.BoundedSemaphore(self.window)
+            self.pending = collections.deque()
+
+    def _lookup(self, cmd):
+        if cmd in self.cache:
+            self.cache[cmd] = value = self.cache.pop(cmd)
+            return value
+        return None
+
+    def _store(self, cmd, value):
+        if self.cache_size:
+            self.cache[cmd] = value
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def E(self, cmd):
+        value = self._lookup(cmd)
+        if value is not None:
+            return value
+
+        if not self.executor:
+            value = E(cmd, self.timeout)
+            self._store(cmd, value)
+            return value
+
+        self.running.acquire()
         try:
-            with open(env.scriptfile, "r") as f:
-                script = f.read()
-        except IOError:
-            pass
+            future = self.executor.submit(E, cmd, self.timeout)
+        except BaseException:
+            self.running.release()
+            raise
+        future.add_done_callback(lambda f: self.running.release())
+        value = CommandResult(future)
+        self._store(cmd, value)
+        return value
+
+    def printer(self, print):
+        """Returns a function to call ``print`` in order of calls."""
+
+        def deferred_print(*args, **kwargs):
+            kwargs['file'] = kwargs.get('file') or sys.stdout
+            waiting = any(isinstance(arg, CommandResult) and not arg.done() for arg in args)
+            if not waiting and not self.pending:
+                print(*args, **kwargs)
+                return
 
+            # Objects are converted now as print() does, since they may be
+            # modified before written.
+            args = [arg if isinstance(arg, (CommandResult, bytes, six.text_type))
+                    else six.text_type(arg) for arg in args]
+            self.pending.append((print, args, kwargs))
+            self._write(self.window)
+
+        return deferred_print
+
+    def _write(self, window):
+        while self.pending:
+            print, args, kwargs = self.pending[0]
+            if len(self.pending) <= window:
+                if any(isinstance(arg, CommandResult) and not arg.done() for arg in args):
+                    return
+            self.pending.popleft()
+            print(*[arg.value() if isinstance(arg, CommandResult) else arg for arg in args],
+                  **kwargs)
+
+    def flush(self):
+        """Writes all queued output."""
+        if self.executor:
+            self._write(0)
+
+    def close(self):
+        if self.executor:
+            try:
+                self.flush()
+            finally:
+                self.pending.clear()
+                self.executor.shutdown(wait=False)
+
+
+def _flush_commands(globals):
+    commands = globals.get('__tse_commands')
+    if commands:
+        commands.flush()
+
+
+def _unresolved_names(env, script):
+    """Returns names which are referred by the codes but not defined.
+
+    Returns None if the codes may refer to any names.
+    """
+    codes = [script, env.exec_actions, env.begincode, env.endcode, env.sortcode]
+    codes.extend(c for r, c in env.actions)
+    codes = [c for c in codes if c]
+
+    names = set()
+    for code in codes:
+        names |= _code_names(code)
+    if names & DYNAMIC_NAMES:
+        return None
+
+    for code in codes:
+        names.difference_update(_stored_names(code))
+    for r, c in env.actions:
+        names.difference_update(r.groupindex)
+    names.difference_update(m.split('.')[0] for m in env.imports)
+    names -= NAMESPACE_NAMES
+    names.difference_update(dir(six.moves.builtins))
+    return set(name for name in names if not RE_LINE_VAR.match(name))
+
+
+def _init_namespace(env, globals, locals):
+    script = env.build_script()
     if script:
-        six.exec_(script + "\n", globals, locals)
+        six.exec_(script, globals, locals)
 
     six.exec_("import sys, os, re", globals, locals)
     six.exec_("from os import path", globals, locals)
-    six.exec_("from glob import *", globals, locals)
-    if PY3:
+    if env.bytes_mode:
+        globals['P'] = print_bytes
+    elif PY3:
         six.exec_("P = print", globals, locals)
 
-    try:
-        six.exec_("from pathlib import *", globals, locals)
-        globals['C'] = pathlib.Path()
-    except ImportError:
-        pass
+    # Aggregators, glob and pathlib are imported only if the codes refer to
+    # names they may define.
+    names = _unresolved_names(env, script)
+    if names is None or names & AGGREGATE_NAMES:
+        six.exec_("from tse.aggregate import *", globals, locals)
+    if names is not None:
+        names -= AGGREGATE_NAMES
+    if names is None or names:
+        six.exec_("from glob import *", globals, locals)
+        try:
+            six.exec_("from pathlib import *", globals, locals)
+            globals['C'] = globals['Path']()
+        except ImportError:
+            pass
 
     for _import in env.imports:
         six.exec_("import %s" % _import, globals, locals)
@@ -290,67 +1765,1421 @@ def run(env):
     for _import in env.imports_star:
         six.exec_("from %s import *" % _import, globals, locals)
 
-    globals['E'] = E
-    
-    if env.begincode:
-        six.exec_(env.begincode, globals, locals)
+    if env.command_jobs or env.command_timeout or env.command_cache:
+        commands = CommandPool(env.command_jobs or 1, env.command_timeout, env.command_cache)
+        globals['__tse_commands'] = commands
+        globals['E'] = commands.E
+        if commands.executor:
+            globals['P'] = commands.printer(globals.get('P', print))
+            globals['print'] = commands.printer(print)
+    else:
+        globals['E'] = E
+
+    globals['STOP'] = STOP
+    if env.max_count or env.max_count_per_file:
+        globals['__tse_counter'] = MatchCounter(env.max_count, env.max_count_per_file)
+
+
+def _run_file(env, f, globals, locals, stats=None):
+    """Process a FILE. Returns a Counter of modified files and written
+    bytes if --inplace is specified. ``stopped`` is counted if STOP() or
+    --max-count stopped the whole input.
+    """
+    if not env.inplace:
+        with env.open_input(f) as input:
+            try:
+                _run_script(env, input, f, globals, locals, stats=stats)
+            except Stop as e:
+                if not e.file:
+                    return collections.Counter(stopped=1)
+        return collections.Counter()
+
+    if _compression(f):
+        raise ValueError('%s: compressed file can not be edited in-place' % f)
+
+    stdout = sys.stdout
+    outfilename = '%s%s.%s' % (f, env.inplace, os.getpid())
+    sys.stdout = env.open_output(outfilename, stats)
+    stopped = None
+    try:
+        try:
+            with env.open_input(f) as input:
+                try:
+                    _run_script(env, input, f, globals, locals, stats=stats)
+                except Stop as e:
+                    # Rest of the file is written unchanged.
+                    stopped = e
+                    _flush_commands(globals)
+                    rest = input.read()
+                    if env.bytes_mode:
+                        _write_bytes(sys.stdout, rest)
+                    else:
+                        sys.stdout.write(rest)
+            _flush_commands(globals)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    except BaseException:
+        os.unlink(outfilename)
+        raise
+
+    counts = _replace_file(env, f, outfilename)
+    if stopped and not stopped.file:
+        counts['stopped'] = 1
+    return counts
+
+
+def _replace_file(env, f, outfilename):
+    import filecmp
+    import shutil
+
+    if filecmp.cmp(f, outfilename, shallow=False):
+        os.unlink(outfilename)
+        return collections.Counter(unchanged=1)
+
+    size = os.path.getsize(outfilename)
+    shutil.copymode(f, outfilename)
+
+    backup = '%s%s' % (f, env.inplace)
+    if backup != f:
+        if os.path.lexists(backup):
+            os.unlink(backup)
+        try:
+            os.link(f, backup)
+        except OSError:
+            shutil.copy2(f, backup)
 
-    # todo: clean up followings
-    if env.exec_actions:
-        six.exec_(env.exec_actions, globals, locals)
+    os.replace(outfilename, f)
+    return collections.Counter(changed=1, bytes=size)
 
-    org_stdout = sys.stdout
-    if env.actions:
-        if not env.inplace:
-            if six.PY2:
-                writer = codecs.getwriter(env.outputenc)
-                writer.encoding = env.outputenc
-                sys.stdout = writer(sys.stdout, env.outputerrors)
+
+class LogState(object):
+    """Offsets of FILEs saved to --state.
+
+    Files are identified by their device and inode numbers as well as
+    paths, so that a log file renamed by rotation is read from the offset
+    of the last run.
+    """
+
+    def __init__(self, filename):
+        import json
+        self.filename = filename
+        try:
+            with io.open(filename, encoding='utf-8') as f:
+                self.files = json.load(f)
+        except (IOError, OSError):
+            if os.path.exists(filename):
+                raise
+            self.files = {}
+        self._saved = None
+
+    def _find(self, path, dev, inode):
+        entry = self.files.get(path)
+        if entry and (entry['dev'], entry['inode']) == (dev, inode):
+            return entry
+        for entry in self.files.values():
+            if (entry['dev'], entry['inode']) == (dev, inode):
+                return entry
+        return None
+
+    def restore(self, reader):
+        """Seek the reader to the offset of the last run. The file is read
+        from the beginning if it is new or truncated."""
+        entry = self._find(os.path.abspath(reader.filename), reader.dev, reader.inode)
+        if entry and entry['offset'] <= os.fstat(reader.file.fileno()).st_size:
+            reader.seek(entry['offset'], entry['lineno'])
+
+    def update(self, reader, filename=None):
+        """Save the offset of the reader. filename is the path of the file
+        if it was renamed."""
+        path = os.path.abspath(filename or reader.filename)
+        for other, entry in list(self.files.items()):
+            if other != path and (entry['dev'], entry['inode']) == (reader.dev, reader.inode):
+                del self.files[other]
+        self.files[path] = {'offset': reader.offset, 'lineno': reader.lineno,
+                            'dev': reader.dev, 'inode': reader.inode}
+
+    def save(self):
+        import json
+        data = six.text_type(json.dumps(self.files, indent=1, sort_keys=True))
+        if data == self._saved:
+            return
+        tmpfilename = '%s.%s' % (self.filename, os.getpid())
+        with io.open(tmpfilename, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmpfilename, self.filename)
+        self._saved = data
+
+
+def _rotated(reader):
+    """Returns True if the file was replaced by a new file, or False if the
+    file was truncated. Returns None if the file was not changed."""
+    try:
+        st = os.stat(reader.filename)
+    except OSError:
+        # The new file has not been created yet.
+        return None
+    if (st.st_dev, st.st_ino) != (reader.dev, reader.inode):
+        return True
+    if st.st_size < reader.offset:
+        return False
+    return None
+
+
+def _renamed(reader):
+    """Returns the path the file was renamed to in the same directory, or
+    None if it was removed."""
+    dirname = os.path.dirname(reader.filename)
+    with os.scandir(dirname or os.curdir) as it:
+        for entry in it:
+            if entry.inode() == reader.inode and entry.is_file(follow_symlinks=False):
+                if entry.stat(follow_symlinks=False).st_dev == reader.dev:
+                    return os.path.join(dirname, entry.name)
+    return None
+
+
+def _run_logs(env, globals, locals, stats=None):
+    """Process lines of FILEs appended since the last run saved to --state.
+    With --follow, wait for FILEs to grow until interrupted."""
+    state = LogState(env.state) if env.state else None
+    readers = []
+    counts = collections.Counter()
+    try:
+        for f in env.iter_files():
+            reader = env.open_log(f)
+            readers.append(reader)
+            if state:
+                state.restore(reader)
+
+        while readers:
+            for i, reader in enumerate(readers):
+                rotated = _rotated(reader) if env.follow else None
+                if rotated is False:
+                    reader.seek(0)
+                stop = None
+                try:
+                    _run_script(env, reader.drain() if rotated else reader, reader.filename,
+                                globals, locals, lineno=reader.lineno + 1, stats=stats)
+                except Stop as e:
+                    stop = e
+                if state:
+                    filename = _renamed(reader) if rotated else reader.filename
+                    if filename:
+                        state.update(reader, filename)
+
+                if stop or rotated:
+                    reader.close()
+                    readers[i] = None if stop else env.open_log(reader.filename)
+                if stop and not stop.file:
+                    counts['stopped'] = 1
+                    break
+
+            readers = [reader for reader in readers if reader]
+            if state:
+                state.save()
+            if not env.follow or counts['stopped']:
+                break
+            _flush_commands(globals)
+            sys.stdout.flush()
+            time.sleep(FOLLOW_INTERVAL)
+    except KeyboardInterrupt:
+        # --follow is stopped by Ctrl-C, and --end is executed.
+        if not env.follow:
+            raise
+        if state:
+            for reader in readers:
+                if reader:
+                    state.update(reader)
+            state.save()
+    finally:
+        for reader in readers:
+            if reader:
+                reader.close()
+    return counts
+
+
+class IgnoreRules(object):
+    """Patterns of .gitignore files of a directory and its parents."""
+
+    def __init__(self, rules=()):
+        # List of (prefix, regex, anchored, negate, dironly).
+        self.rules = rules
+
+    @staticmethod
+    def _translate(pattern):
+        ret = []
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith('**/', i):
+                ret.append('(?:.*/)?')
+                i += 3
+            elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+                ret.append('/.*')
+                i += 3
+            elif pattern[i] == '*':
+                ret.append('[^/]*')
+                i += 1
+            elif pattern[i] == '?':
+                ret.append('[^/]')
+                i += 1
+            elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+                # Only a leading ! negates the class, and ] right after
+                # [ or [! is a literal.
+                negate = pattern.startswith('!', i + 1)
+                start = i + 2 if negate else i + 1
+                end = pattern.find(']', start + 1)
+                if end == -1:
+                    ret.append(re.escape(pattern[i]))
+                    i += 1
+                    continue
+                chars = re.sub(r'([\\^\[\]&~|])', r'\\\1', pattern[start:end])
+                ret.append(('[^/' if negate else '[') + chars + ']')
+                i = end + 1
+            elif pattern[i] == '\\' and i + 1 < len(pattern):
+                ret.append(re.escape(pattern[i + 1]))
+                i += 2
             else:
-                if hasattr(sys.stdout, 'buffer'):
-                    sys.stdout = io.open(os.dup(sys.stdout.buffer.fileno()), 'w', 
-                        encoding=env.outputenc, errors=env.outputerrors)
+                ret.append(re.escape(pattern[i]))
+                i += 1
+        return re.compile(''.join(ret) + '$')
 
-        if not env.files:
-            if six.PY2:
-                reader = codecs.getreader(env.inputenc)(sys.stdin, env.inputerrors)
+    def read(self, dirname, prefix):
+        """Returns rules with patterns of .gitignore in dirname. Paths in
+        the directory start with prefix."""
+        try:
+            with io.open(os.path.join(dirname, '.gitignore'), encoding='utf-8',
+                         errors='surrogateescape') as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            return self
+
+        rules = list(self.rules)
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            dironly = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if line:
+                rules.append((prefix, self._translate(line), anchored, negate, dironly))
+        return IgnoreRules(rules)
+
+    def ignored(self, path, name, isdir):
+        ret = False
+        for prefix, regex, anchored, negate, dironly in self.rules:
+            if dironly and not isdir:
+                continue
+            if regex.match(path[len(prefix):] if anchored else name):
+                ret = not negate
+        return ret
+
+
+def _is_binary(filename):
+    """Returns True if the first block of the file contains NUL and the
+    file is not compressed."""
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        head = os.read(fd, SNIFF_SIZE)
+    finally:
+        os.close(fd)
+    return b'\0' in head and not _compression(filename)
+
+
+def _scan_dir(env, dirname, rules):
+    """Returns a list of (path, rules) of the entries of the directory in
+    order of names. rules is None for files."""
+    prefix = '' if dirname == os.curdir else os.path.join(dirname, '')
+    entries = []
+    try:
+        with os.scandir(dirname) as it:
+            for entry in it:
+                # Symbolic links to directories are not followed.
+                entries.append((entry.name, entry.is_dir(follow_symlinks=False),
+                                entry.is_file()))
+    except OSError as e:
+        # Unreadable or removed directories are skipped as grep -r.
+        sys.stderr.write('%s: %s: %s\n' % (SHORTAPPNAME, dirname, e.strerror or e))
+        return []
+
+    if env.gitignore and any(name == '.gitignore' for name, isdir, isfile in entries):
+        rules = rules.read(dirname, prefix)
+
+    # Binary files can not be detected if b'\n' is not a newline.
+    sniff = not env.bytes_mode and u'\n'.encode(env.inputenc) == b'\n'
+
+    import fnmatch
+    ret = []
+    for name, isdir, isfile in sorted(entries):
+        path = prefix + name
+        if any(fnmatch.fnmatch(name, pat) for pat in env.exclude):
+            continue
+        if env.gitignore and (name == '.git' or rules.ignored(path, name, isdir)):
+            continue
+        if isdir:
+            ret.append((path, rules))
+            continue
+        if env.include and not any(fnmatch.fnmatch(name, pat) for pat in env.include):
+            continue
+        if not isfile:
+            continue
+        if sniff and _is_binary(path):
+            continue
+        ret.append((path, None))
+    return ret
+
+
+def _walk(env, top):
+    """Yields files under the directory in order of names.
+
+    Directories are read by threads before they are visited.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor()
+
+    def visit(future):
+        entries = []
+        for path, rules in future.result():
+            if rules is not None:
+                entries.append((path, executor.submit(_scan_dir, env, path, rules)))
+            else:
+                entries.append((path, None))
+
+        for path, subdir in entries:
+            if subdir is None:
+                yield path
+            else:
+                for f in visit(subdir):
+                    yield f
+
+    try:
+        for f in visit(executor.submit(_scan_dir, env, top, IgnoreRules())):
+            yield f
+    finally:
+        executor.shutdown(wait=False)
+
+
+def merge(a, b):
+    """Merge values of a variable computed by two worker processes."""
+    if hasattr(a, 'merge'):
+        return a.merge(b)
+    if isinstance(a, dict):
+        ret = a.copy()
+        for k, v in b.items():
+            ret[k] = merge(ret[k], v) if k in ret else v
+        return ret
+    if isinstance(a, (set, frozenset)):
+        return a | b
+    if isinstance(a, (list, tuple)):
+        return a + b
+    if isinstance(a, numbers.Number) and not isinstance(a, bool):
+        return a + b
+    return b
+
+
+_worker = None
+
+
+def _init_worker(env):
+    global _worker
+    namespace = {}
+    _init_namespace(env, namespace, namespace)
+    _worker = (env, namespace, dict(namespace))
+
+
+def _split_file(env, filename):
+    """Split a file into byte ranges aligned on line boundaries."""
+
+    if not env.chunk_size or env.inplace or _compression(filename):
+        return None
+    if env.record_separator is not None or env.max_count_per_file:
+        return None
+    if not env.bytes_mode:
+        try:
+            # Chunks can be decoded separately only if b'\n' is always a newline.
+            if u'\n'.encode(env.inputenc) != b'\n' or u'\r\n'.encode(env.inputenc) != b'\r\n':
+                return None
+        except LookupError:
+            return None
+
+    size = os.path.getsize(filename)
+    if size <= env.chunk_size:
+        return None
+
+    import mmap
+    ranges = []
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while start < size:
+                end = mm.find(b'\n', start + env.chunk_size - 1)
+                end = size if end == -1 else end + 1
+                ranges.append((start, end))
+                start = end
+        finally:
+            mm.close()
+    return ranges
+
+
+def _count_lines(chunk):
+    filename, start, end = chunk
+    import mmap
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return mm[start:end].count(b'\n')
+        finally:
+            mm.close()
+
+
+def _job_tasks(env, pool):
+    if not env.chunk_size:
+        # FILEs are read as tasks are passed to the workers.
+        return ((f, None, None, 1) for f in env.iter_files())
+
+    tasks = []
+    for f in env.iter_files():
+        ranges = _split_file(env, f)
+        if not ranges:
+            tasks.append((f, None, None, 1))
+            continue
+
+        counts = pool.map(_count_lines, [(f, start, end) for start, end in ranges])
+        lineno = 1
+        for (start, end), count in zip(ranges, counts):
+            tasks.append((f, start, end, lineno))
+            lineno += count
+    return tasks
+
+
+def _run_job(task):
+    env, namespace, initial = _worker
+    filename, start, end, lineno = task
+
+    # Each task is processed with a clean namespace. The dictionary object
+    # is reused to keep the compiled loop.
+    namespace.clear()
+    namespace.update(initial)
+    if env.begincode:
+        six.exec_(env.begincode, namespace, namespace)
+
+    stdout = sys.stdout
+    if env.bytes_mode:
+        buffer = io.BytesIO()
+        sys.stdout = io.TextIOWrapper(buffer, encoding=env.outputenc,
+                                      errors=env.outputerrors, write_through=True)
+    elif not env.inplace:
+        sys.stdout = io.StringIO()
+    counts = collections.Counter()
+    stats = Stats(env) if env.stats else None
+    try:
+        if start is None:
+            counts = _run_file(env, filename, namespace, namespace, stats)
+        else:
+            with open(filename, 'rb') as f:
+                f.seek(start)
+                input = io.BytesIO(f.read(end - start))
+            if not env.bytes_mode:
+                input = io.TextIOWrapper(input, encoding=env.inputenc,
+                                         errors=env.inputerrors)
+            try:
+                _run_script(env, input, filename, namespace, namespace, lineno, stats)
+            except Stop as e:
+                # STOP(file=True) stops only the chunk.
+                if not e.file:
+                    counts['stopped'] = 1
+
+        _flush_commands(namespace)
+        if env.bytes_mode:
+            output = buffer.getvalue()
+        else:
+            output = u'' if env.inplace else sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+    import pickle
+    results = {}
+    for name in env.begin_names:
+        if name in namespace:
+            try:
+                pickle.dumps(namespace[name])
+            except Exception:
+                continue
+            results[name] = namespace[name]
+    return output, results, counts, stats
+
+
+def _run_jobs(env, globals, locals, stats=None):
+    import multiprocessing
+
+    results = []
+    counts = collections.Counter()
+    with multiprocessing.Pool(env.jobs, _init_worker, (env,)) as pool:
+        tasks = _job_tasks(env, pool)
+        imap = pool.imap_unordered if env.unordered else pool.imap
+        for output, result, count, job_stats in imap(_run_job, tasks):
+            if isinstance(output, bytes):
+                _write_bytes(sys.stdout, output)
             else:
-                reader = io.open(os.dup(sys.stdin.buffer.fileno()), 
-                    encoding=env.inputenc, errors=env.inputerrors)
-            _run_script(env, reader, '<stdin>', globals, locals)
+                sys.stdout.write(output)
+            results.append(result)
+            counts.update(count)
+            if stats is not None:
+                stats.merge(job_stats)
+            if count['stopped']:
+                # Workers processing other FILEs are terminated.
+                break
+
+    locals['RESULTS'] = results
+    for name in env.begin_names:
+        values = [result[name] for result in results if name in result]
+        if values:
+            locals[name] = functools.reduce(merge, values)
+    return counts
+
+
+class ReadAheadReader(object):
+    """Reads blocks of ``stream`` in a background thread.
+
+    Blocks are split at line boundaries and passed to readers through a
+    bounded queue. Iterating the reader yields lines without newlines.
+    """
+
+    QUEUE_SIZE = 4
+
+    def __init__(self, stream, newline=u'\n', block_size=BUFFER_SIZE):
+        self.stream = stream
+        self.newline = newline
+        self.block_size = block_size
+        self._empty = newline[:0]
+        self._pending = self._empty
+        self._eof = False
+        self._closing = False
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._closing:
+                block = self.stream.read(self.block_size)
+                if block and not block.endswith(self.newline):
+                    block += self.stream.readline()
+                self._queue.put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self._queue.put(e)
+
+    def _next_block(self):
+        if self._eof:
+            return self._empty
+        block = self._queue.get()
+        if isinstance(block, Exception):
+            self._eof = True
+            raise block
+        if not block:
+            self._eof = True
+        return block
+
+    def read(self, size=-1):
+        """Read the next block. The size of the block may differ from size,
+        unless size is negative."""
+        if size is not None and size < 0:
+            blocks = [self._pending]
+            self._pending = self._empty
+            while True:
+                block = self._next_block()
+                if not block:
+                    return self._empty.join(blocks)
+                blocks.append(block)
+
+        if self._pending:
+            block, self._pending = self._pending, self._empty
+            return block
+        return self._next_block()
+
+    def readline(self):
+        while self.newline not in self._pending:
+            block = self._next_block()
+            if not block:
+                line, self._pending = self._pending, self._empty
+                return line
+            self._pending += block
+        pos = self._pending.index(self.newline) + 1
+        line, self._pending = self._pending[:pos], self._pending[pos:]
+        return line
+
+    def __iter__(self):
+        newline = self.newline
+        while True:
+            block = self.read()
+            if not block:
+                return
+            lines = block.split(newline)
+            if not lines[-1]:
+                lines.pop()
+            for line in lines:
+                yield line
+
+    def close(self):
+        self._closing = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordReader(object):
+    """Reads records of ``stream`` separated by ``separator``.
+
+    ``separator`` is a string or a compiled regex. Large blocks of the
+    stream are split at once instead of reading each line. In paragraph
+    mode, empty records and newlines at the beginning of records are
+    skipped. read() returns the input after the last record yielded.
+    """
+
+    def __init__(self, stream, separator, paragraph=False, block_size=BUFFER_SIZE):
+        self.stream = stream
+        self.separator = separator
+        self.paragraph = paragraph
+        self.block_size = block_size
+        if isinstance(separator, (six.text_type, bytes)):
+            self._empty = separator[:0]
         else:
-            for f in env.files:
-                stdout = sys.stdout
-                if env.inplace:
-                    outfilename = '%s%s.%s' % (f, env.inplace, os.getpid())
-                    if six.PY2:
-                        writer = codecs.getwriter(env.outputenc)
-                        writer.encoding = env.outputenc
-                        sys.stdout = writer(open(outfilename, 'w'))
-                    else:
-                        sys.stdout = io.open(
-                            outfilename, 'w', encoding=env.outputenc)
-                try:
-                    with io.open(f, 'r', encoding=env.inputenc, errors=env.inputerrors) as input:
-                        _run_script(env, input, f, globals, locals)
-                finally:
-                    if env.inplace:
-                        sys.stdout.close()
-                        sys.stdout = stdout
+            self._empty = separator.pattern[:0]
+        # Records after _pos of _buf are not yielded yet.
+        self._buf = self._empty
+        self._pos = 0
+
+    def _fill(self):
+        # Read at least as much as pending, so that a record longer than
+        # the block is not concatenated too many times.
+        pending = self._buf[self._pos:]
+        block = self.stream.read(max(self.block_size, len(pending)))
+        self._buf = pending + block
+        self._pos = 0
+        return block
+
+    def _split_literal(self):
+        separator = self.separator
+        size = len(separator)
+        while self._fill():
+            records = self._buf.split(separator)
+            records.pop()
+            for record in records:
+                self._pos += len(record) + size
+                yield record
+
+    def _split_regex(self):
+        finditer = self.separator.finditer
+        eof = False
+        while not eof:
+            eof = not self._fill()
+            buf = self._buf
+            for m in finditer(buf):
+                start, end = m.span()
+                if start == end:
+                    continue
+                # The separator may continue in the next block.
+                if end == len(buf) and not eof:
+                    break
+                record = buf[self._pos:start]
+                self._pos = end
+                yield record
+
+    def _records(self):
+        if isinstance(self.separator, (six.text_type, bytes)):
+            records = self._split_literal()
+        else:
+            records = self._split_regex()
+        for record in records:
+            yield record
+        record, self._buf, self._pos = self._buf[self._pos:], self._empty, 0
+        if record:
+            yield record
+
+    def __iter__(self):
+        if not self.paragraph:
+            return self._records()
+        return self._paragraphs()
+
+    def _paragraphs(self):
+        newline = b'\n' if isinstance(self._empty, bytes) else u'\n'
+        for record in self._records():
+            record = record.lstrip(newline)
+            if record:
+                yield record
+
+    def read(self, size=-1):
+        """Read the rest of the input."""
+        rest, self._buf, self._pos = self._buf[self._pos:], self._empty, 0
+        return rest + self.stream.read()
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LogReader(object):
+    """Reads lines of a growing file from a byte offset.
+
+    Lines are yielded without newlines, and a line is not read until its
+    newline is written, so that ``offset`` is always at the start of the
+    next line. ``lineno`` is the number of lines yielded, including those
+    before the offset. Iterating again yields lines appended since.
+    """
+
+    def __init__(self, filename, encoding=None, errors='strict', block_size=BUFFER_SIZE):
+        self.filename = filename
+        self.encoding = encoding
+        self.errors = errors
+        self.block_size = block_size
+        self.file = io.open(filename, 'rb', buffering=0)
+        st = os.fstat(self.file.fileno())
+        self.dev, self.inode = st.st_dev, st.st_ino
+        self.seek(0)
+
+    def seek(self, offset, lineno=0):
+        self.file.seek(offset)
+        # Offset and lineno of the start of _block. Lines of _block are
+        # yielded by _lines, so that lines are iterated without running
+        # Python code for each line.
+        self._offset = offset
+        self._lineno = lineno
+        self._block = []
+        self._lines = iter(())
+        self._rest = b''
+
+    def _consumed(self):
+        return len(self._block) - operator.length_hint(self._lines)
+
+    @property
+    def offset(self):
+        return self._offset + sum(len(line) + 1 for line in self._block[:self._consumed()])
+
+    @property
+    def lineno(self):
+        return self._lineno + self._consumed()
+
+    def _load(self, data):
+        """Returns an iterator of lines of data, which ends with a newline."""
+        self._offset, self._lineno = self.offset, self.lineno
+        self._block = data.split(b'\n')
+        self._block.pop()
+        if self.encoding is None:
+            lines = self._block
+        else:
+            text = data.decode(self.encoding, self.errors)
+            if u'\r' in text:
+                text = text.replace(u'\r\n', u'\n')
+            lines = text.split(u'\n')
+            lines.pop()
+        self._lines = iter(lines)
+        return self._lines
+
+    def _blocks(self):
+        while True:
+            data = self.file.read(self.block_size)
+            if not data:
+                return
+            data = self._rest + data
+            end = data.rfind(b'\n') + 1
+            self._rest = data[end:]
+            if end:
+                yield self._load(data[:end])
+
+    def _last(self):
+        if self._rest:
+            lines = self._load(self._rest + b'\n')
+            self._rest = b''
+            # The newline appended above is not in the file.
+            self._offset -= 1
+            yield lines
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks())
+
+    def drain(self):
+        """Returns an iterator of the rest of lines, including the last line
+        without newline. Used when the file is not written anymore."""
+        return itertools.chain.from_iterable(itertools.chain(self._blocks(), self._last()))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncWriter(io.RawIOBase):
+    """Raw stream to write to ``raw`` in a background thread.
+
+    Written blocks are passed to the thread through a bounded queue, so
+    writers are blocked only if the queue is full. Errors in the thread are
+    raised by following write(), flush() or check().
+    """
+
+    QUEUE_SIZE = 4
+
+    def __init__(self, raw):
+        self.raw = raw
+        # An error raised in the thread.
+        self.error = None
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def writable(self):
+        return True
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def isatty(self):
+        return self.raw.isatty()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    return
+                if self.error is None:
+                    data = memoryview(data)
+                    while data:
+                        data = data[self.raw.write(data) or 0:]
+            except Exception as e:
+                self.error = e
+            finally:
+                self._queue.task_done()
+
+    def check(self):
+        """Raises an error of the thread, e.g. BrokenPipeError if the reader
+        has gone, without waiting for the buffer to be written."""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        self.check()
+        self._queue.put(bytes(b))
+        return len(b)
+
+    def flush(self):
+        if self.closed or self.raw.closed:
+            return
+        self._queue.join()
+        self.raw.flush()
+        self.check()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self.raw.close()
+            super(AsyncWriter, self).close()
+
+
+class WriteCounter(io.RawIOBase):
+    """Raw stream to count bytes written to ``raw`` in ``stats.output``."""
+
+    def __init__(self, raw, stats):
+        self.raw = raw
+        self.stats = stats
+
+    def writable(self):
+        return True
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def isatty(self):
+        return self.raw.isatty()
+
+    def write(self, b):
+        n = self.raw.write(b)
+        self.stats.output += n or 0
+        return n
+
+    def flush(self):
+        self.raw.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                super(WriteCounter, self).close()
+            finally:
+                self.raw.close()
+
+
+class SortedOutput(object):
+    """Text stream to sort lines written, and write them to ``output`` at
+    finish().
+
+    Lines are kept in memory up to about ``memory`` bytes, and then
+    sorted and spilled to a temporary file. The files are merged at
+    finish(). With ``uniq``, duplicated lines are removed. With ``count``,
+    lines are counted and prefixed by the counts as ``uniq -c``. Duplicates
+    are removed before spilling, so only distinct lines are kept in
+    memory.
+    """
+
+    def __init__(self, output, key=None, uniq=False, count=False, memory=None,
+                 bytes_mode=False):
+        self.output = output
+        self.encoding = getattr(output, 'encoding', None) or 'utf-8'
+        self.bytes_mode = bytes_mode
+        self.memory = memory or SORT_MEMORY
+        self.count = count
+        self.uniq = uniq or count
+
+        # Items are lines, or (line, count) with count. Equal lines must be
+        # adjacent after sorting by a key.
+        if count:
+            self._key = (lambda item: (key(item[0]), item[0])) if key else None
+        elif uniq:
+            self._key = (lambda line: (key(line), line)) if key else None
+        else:
+            self._key = key
+
+        self._chunks = []
+        self._pending = 0
+        self._runs = []
+        self._reset()
+
+    def _reset(self):
+        if self.count:
+            self._items = collections.Counter()
+        elif self.uniq:
+            self._items = set()
+        else:
+            self._items = []
+        self._add = self._items.extend if not self.uniq else self._items.update
+        # Estimated memory used by _items.
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        self._chunks.append(s)
+        self._pending += len(s)
+        if self._pending >= BUFFER_SIZE:
+            self._add_lines()
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def _add_lines(self, final=False):
+        text = u''.join(self._chunks)
+        lines = text.split(u'\n')
+        rest = lines.pop()
+        if final and rest:
+            lines.append(rest)
+            rest = u''
+        self._chunks = [rest] if rest else []
+        self._pending = len(rest)
+        if not lines:
+            return
+
+        n = len(self._items)
+        self._add(lines)
+        # Size of str objects and references to them.
+        self._size += (len(self._items) - n) * (len(text) // len(lines) + 64)
+        if self._size >= self.memory:
+            self._spill()
+
+    def _sorted(self):
+        items = self._items
+        if self.count:
+            return sorted(items.items(), key=self._key)
+        if self.uniq:
+            return sorted(items, key=self._key)
+        items.sort(key=self._key)
+        return items
+
+    def _spill(self):
+        self._runs.append(self._write_run(self._sorted()))
+        self._reset()
+        if len(self._runs) >= MERGE_WIDTH:
+            runs = self._runs
+            self._runs = [self._write_run(self._merge([self._read_run(f) for f in runs]))]
+            for f in runs:
+                f.close()
+
+    def _write_run(self, items):
+        import tempfile
+        f = tempfile.TemporaryFile('w+', encoding='utf-8', errors='surrogatepass', newline='\n')
+        if self.count:
+            f.writelines(u'%d\t%s\n' % (n, line) for line, n in items)
+        else:
+            f.writelines(line + u'\n' for line in items)
+        f.seek(0)
+        return f
+
+    def _read_run(self, f):
+        if self.count:
+            for record in f:
+                n, _, line = record.partition(u'\t')
+                yield line[:-1], int(n)
+        else:
+            for line in f:
+                yield line[:-1]
+
+    def _merge(self, iterables):
+        import heapq
+        merged = heapq.merge(*iterables, key=self._key)
+        if self.count:
+            return ((line, sum(n for _, n in group))
+                    for line, group in itertools.groupby(merged, operator.itemgetter(0)))
+        if self.uniq:
+            return (line for line, _ in itertools.groupby(merged))
+        return merged
+
+    def _write(self, s):
+        if self.bytes_mode:
+            _write_bytes(self.output, s.encode(self.encoding, 'surrogateescape'))
+        else:
+            self.output.write(s)
+
+    def finish(self):
+        """Write sorted lines to the output."""
+        self._add_lines(final=True)
+        items = self._sorted()
+        if self._runs:
+            items = self._merge([self._read_run(f) for f in self._runs] + [items])
+        if self.count:
+            items = (u'%7d %s' % (n, line) for line, n in items)
+
+        self.output.flush()
+        items = iter(items)
+        while True:
+            lines = list(itertools.islice(items, 8192))
+            if not lines:
+                break
+            lines.append(u'')
+            self._write(u'\n'.join(lines))
+        self._reset()
+
+    def close(self):
+        for f in self._runs:
+            f.close()
+        self._runs = []
+
+
+def _write_bytes(file, data):
+    buffer = getattr(file, 'buffer', None)
+    if buffer is not None:
+        buffer.write(data)
+    else:
+        file.write(data.decode(getattr(file, 'encoding', None) or 'utf-8', 'surrogateescape'))
+
+
+def print_bytes(*args, **kwargs):
+    """print() for --bytes mode. bytes objects are written without
+    conversion, and other objects are converted to str and encoded.
+    """
+    file = kwargs.get('file') or sys.stdout
+    if len(args) == 1 and not kwargs and type(args[0]) is bytes:
+        buffer = getattr(file, 'buffer', None)
+        if buffer is not None:
+            buffer.write(args[0] + b'\n')
+            return
+
+    encoding = getattr(file, 'encoding', None) or 'utf-8'
+    errors = getattr(file, 'errors', None) or 'strict'
+
+    def tobytes(s):
+        if isinstance(s, (bytes, bytearray, memoryview)):
+            return bytes(s)
+        return six.text_type(s).encode(encoding, errors)
+
+    sep = kwargs.get('sep')
+    end = kwargs.get('end')
+    sep = b' ' if sep is None else tobytes(sep)
+    end = b'\n' if end is None else tobytes(end)
+    _write_bytes(file, sep.join(tobytes(s) for s in args) + end)
+    if kwargs.get('flush'):
+        file.flush()
+
+
+def _startup(name):
+    _STARTUP.append((name, time.time()))
+
+
+def _report_startup(file):
+    interpreter = _STARTUP_CPU * 1000
+    times = ['interpreter %.1fms' % interpreter]
+    for (name, t), (_, prev) in zip(_STARTUP[1:], _STARTUP):
+        times.append('%s %.1fms' % (name, (t - prev) * 1000))
+    total = interpreter + (_STARTUP[-1][1] - _STARTUP[0][1]) * 1000
+    file.write('%s: startup: %s, total %.1fms, %d modules\n' % (
+        SHORTAPPNAME, ', '.join(times), total, len(sys.modules)))
 
-                if env.inplace:
-                    shutil.move(f, '%s%s' % (f, env.inplace))
-                    shutil.move(outfilename, f)
+
+def _run_actions(env, globals, locals, stats, started):
+    org_stdout = sys.stdout
+    counts = collections.Counter()
+    if not env.inplace:
+        sys.stdout = env.open_output(stats=stats)
+        writer = getattr(getattr(sys.stdout, 'buffer', None), 'raw', None)
+        if isinstance(writer, AsyncWriter):
+            globals['__tse_output'] = writer
+    sorter = env.open_sorter(sys.stdout, globals)
+    if sorter:
+        sys.stdout = sorter
+    if stats:
+        stats.setup = time.perf_counter() - started
+    try:
+        if not env.files:
+            try:
+                _run_script(env, env.open_input(), '<stdin>', globals, locals, stats=stats)
+            except Stop:
+                pass
+        elif env.follow or env.state:
+            counts = _run_logs(env, globals, locals, stats)
+        elif env.jobs and env.jobs > 1:
+            counts = _run_jobs(env, globals, locals, stats)
+        else:
+            for f in env.iter_files():
+                counts.update(_run_file(env, f, globals, locals, stats))
+                if counts['stopped']:
+                    break
+        _flush_commands(globals)
+        if sorter:
+            sorter.finish()
+    finally:
+        if sorter:
+            sorter.close()
+            sys.stdout = sorter.output
+        globals.pop('__tse_output', None)
+        stdout, sys.stdout = sys.stdout, org_stdout
+        if stdout is not org_stdout:
+            stdout.close()
+    return counts
+
+
+def _discard_output():
+    """Redirect the standard output to the null device."""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, sys.stdout.fileno())
+    finally:
+        os.close(devnull)
+
+
+def run(env):
+
+    started = time.perf_counter()
+    locals = globals = {}
+
+    _init_namespace(env, globals, locals)
+    _startup('namespace')
+
+    if env.begincode:
+        six.exec_(env.begincode, globals, locals)
+    _startup('begin')
+
+    if env.startup_profile:
+        _report_startup(sys.stderr)
+
+    stats = Stats(env) if env.stats else None
+    profiler = None
+    if env.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    counts = collections.Counter()
+    try:
+        # todo: clean up followings
+        if env.exec_actions:
+            six.exec_(env.exec_actions, globals, locals)
+        if env.actions:
+            counts = _run_actions(env, globals, locals, stats, started)
+    except Stop:
+        pass
+    except BrokenPipeError:
+        # The reader has gone (e.g. tse ... | head). Input is not read
+        # anymore, but --end is executed with the output discarded.
+        _discard_output()
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(env.profile)
+
+    if stats:
+        stats.elapsed = time.perf_counter() - started - stats.setup
+        stats.report(sys.stderr)
+
+    if env.inplace and env.verbose:
+        sys.stderr.write('%s: %d file(s) changed, %d file(s) unchanged, %d byte(s) written\n' % (
+            SHORTAPPNAME, counts['changed'], counts['unchanged'], counts['bytes']))
 
     sys.stdout.flush()
-    sys.stdout = org_stdout
 
     if env.endcode:
         six.exec_(env.endcode, globals, locals)
 
+    commands = globals.get('__tse_commands')
+    if commands:
+        commands.close()
+        sys.stdout.flush()
+
     return locals
 
 
+def serve(env, path, idle_timeout=None, workers=None):
+    """Executes requests of tse.client received on a Unix domain socket.
+
+    Each request is executed in a process forked from the server, so
+    modules imported by the server are shared and requests are isolated
+    from each other. The server exits if no request is received for
+    idle_timeout seconds.
+    """
+    import select
+    import signal
+    from tse import client
+
+    # Import modules and execute the script file in advance.
+    namespace = {}
+    _init_namespace(env, namespace, namespace)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    listener = client.listen(path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = workers or os.cpu_count() or 1
+    children = set()
+    last = time.time()
+    try:
+        while True:
+            while children:
+                pid, status = os.waitpid(-1, 0 if len(children) >= workers else os.WNOHANG)
+                if not pid:
+                    break
+                children.discard(pid)
+                last = time.time()
+
+            if idle_timeout and not children and time.time() - last > idle_timeout:
+                break
+
+            if not select.select([listener], [], [], 1.0)[0]:
+                continue
+
+            conn, addr = listener.accept()
+            try:
+                client.check_peer(conn)
+            except OSError as e:
+                sys.stderr.write('%s: request refused: %s\n' % (SHORTAPPNAME, e))
+                conn.close()
+                continue
+            pid = os.fork()
+            if not pid:
+                listener.close()
+                try:
+                    _serve_request(conn)
+                finally:
+                    os._exit(0)
+            conn.close()
+            children.add(pid)
+            last = time.time()
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _serve_request(conn):
+    import traceback
+    from tse import client
+
+    status = 1
+    done = threading.Event()
+    try:
+        request, fds = client.recv_request(conn)
+        for fd, stdfd in zip(fds, (0, 1, 2)):
+            os.dup2(fd, stdfd)
+            os.close(fd)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = [SHORTAPPNAME] + request['argv']
+
+        # Stop when the client is terminated.
+        threading.Thread(target=_watch_client, args=(conn, done), daemon=True).start()
+
+        try:
+            if '--server' in request['argv']:
+                sys.exit('%s: --server can not be requested to the server' % SHORTAPPNAME)
+            main(request['argv'])
+            status = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                sys.stderr.write('%s\n' % e.code)
+        except KeyboardInterrupt:
+            status = 130
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+    finally:
+        done.set()
+        try:
+            client.send_status(conn, status)
+        except (OSError, EOFError):
+            pass
+        conn.close()
+
+
+def _watch_client(conn, done):
+    import signal
+    try:
+        conn.recv(1)
+    except OSError:
+        pass
+    if not done.is_set():
+        os.kill(os.getpid(), signal.SIGINT)
+
+
 class ScriptAction(argparse._StoreAction):
 
     def __call__(self, parser, namespace, values, option_string=None):
@@ -412,6 +3241,21 @@ def getargparser():
             raise argparse.ArgumentTypeError("module name should not contain: %s" % ','.join(l))
         return s
 
+    def widthsstr(s):
+        try:
+            widths = [int(w) for w in s.split(',')]
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid widths: %s" % s)
+        if any(w <= 0 for w in widths):
+            raise argparse.ArgumentTypeError("invalid widths: %s" % s)
+        return widths
+
+    def sizestr(s):
+        m = re.match(r'(\d+)([kmg]?)b?$', s.strip().lower())
+        if not m:
+            raise argparse.ArgumentTypeError("invalid size: %s" % s)
+        return int(m.group(1)) * 1024 ** ' kmg'.index(m.group(2) or ' ')
+
     parser = argparse.ArgumentParser(description=LOGAPPNAME)
     parser.add_argument(
         '--statement', '-s', action=StatementAction, nargs='+', type=argstr,
@@ -431,9 +3275,135 @@ def getargparser():
     parser.add_argument(
         '--field-separator', '-F', action='store', type=argstr,
         help='regular expression used to separate fields.')
+    parser.add_argument(
+        '--csv', action='store_const', const='csv', dest='field_format',
+        help='split lines into fields as CSV.')
+    parser.add_argument(
+        '--tsv', action='store_const', const='tsv', dest='field_format',
+        help='split lines into fields as tab-separated values.')
+    parser.add_argument(
+        '--widths', action='store', type=widthsstr, metavar='W1,W2,...',
+        help='split lines into fields of fixed widths.')
+    parser.add_argument(
+        '--record-separator', '--rs', action='store', type=argstr, metavar='RS',
+        help='regular expression used to separate records instead of newlines. '
+             'records are separated by blank lines if RS is empty.')
+    parser.add_argument(
+        '--max-count', action='store', type=int, metavar='N',
+        help='stop reading input after N lines are matched.')
+    parser.add_argument(
+        '--max-count-per-file', action='store', type=int, metavar='N',
+        help='stop reading each FILE after N lines are matched.')
+    parser.add_argument(
+        '--batch', action='store', type=int, metavar='N',
+        help='execute actions for each batch of N lines in LINES, LINENOS and '
+             'FIELDS.')
+    parser.add_argument(
+        '--recursive', '-r', action='store_true',
+        help='read files under directories recursively. binary files and files '
+             'ignored by .gitignore are skipped.')
+    parser.add_argument(
+        '--include', action='append', type=argstr, metavar='GLOB',
+        help='with --recursive, read only files whose name matches GLOB.')
+    parser.add_argument(
+        '--exclude', action='append', type=argstr, metavar='GLOB',
+        help='with --recursive, skip files and directories whose name matches GLOB.')
+    parser.add_argument(
+        '--no-ignore', action='store_false', dest='gitignore',
+        help='with --recursive, do not skip files ignored by .gitignore.')
+    parser.add_argument(
+        '--follow', action='store_true',
+        help='keep reading lines appended to FILEs until interrupted. rotated '
+             'and truncated FILEs are read from the beginning.')
+    parser.add_argument(
+        '--state', action='store', type=argstr, metavar='STATEFILE',
+        help='save offsets of FILEs read to STATEFILE, and read only lines '
+             'appended since the last run.')
+    parser.add_argument(
+        '--sort', action='store', nargs='?', const='', type=argstr, metavar='KEY',
+        dest='sort_key',
+        help='sort lines written by actions. KEY is an expression of the line L to '
+             'compare lines, e.g. "int(L.split()[1])".')
+    parser.add_argument(
+        '--uniq', action='store_true',
+        help='sort lines written by actions, and remove duplicated lines.')
+    parser.add_argument(
+        '--uniq-count', action='store_true',
+        help='sort lines written by actions, and prefix lines by the number of '
+             'occurrences as "uniq -c".')
+    parser.add_argument(
+        '--sort-memory', action='store', type=sizestr, metavar='SIZE',
+        help='memory used by --sort, --uniq and --uniq-count before spilling '
+             'lines to temporary files (default: 256M).')
+    parser.add_argument(
+        '--compile', action='store_true', dest='compile_loop',
+        help='compile statements into a function to process lines faster.')
+    parser.add_argument(
+        '--jobs', '-j', action='store', type=int, metavar='N',
+        help='number of processes to process FILEs in parallel.')
+    parser.add_argument(
+        '--unordered', action='store_true',
+        help='with --jobs, write output of FILEs in order of completion.')
+    parser.add_argument(
+        '--chunk-size', action='store', type=sizestr, metavar='SIZE',
+        help='with --jobs, split FILEs larger than SIZE (e.g. 64M) into chunks '
+             'processed in parallel.')
+    parser.add_argument(
+        '--bytes', action='store_true', dest='bytes_mode',
+        help='process input as bytes without decoding.')
+    parser.add_argument(
+        '--scan', action='store_true',
+        help='search patterns in blocks of input instead of each line.')
+    parser.add_argument(
+        '--buffer-size', action='store', type=sizestr, metavar='SIZE',
+        help='size of output buffer (e.g. 4M).')
+    parser.add_argument(
+        '--line-buffered', action='store_true',
+        help='flush output at every line.')
+    parser.add_argument(
+        '--command-jobs', action='store', type=int, metavar='N',
+        help='run commands of E() and backticks in N threads. output of '
+             'print() and P() is written in order.')
+    parser.add_argument(
+        '--command-timeout', action='store', type=float, metavar='SECONDS',
+        help='timeout of commands of E() and backticks.')
+    parser.add_argument(
+        '--command-cache', action='store', type=int, metavar='N',
+        help='reuse output of the last N distinct commands of E() and backticks.')
     parser.add_argument(
         '--inplace', action='store', type=argstr, metavar='EXTENSION',
-        help='edit files in-place.')
+        help='edit files in-place. files are not modified if the content is '
+             'not changed.')
+    parser.add_argument(
+        '--no-cache', action='store_false', dest='cache',
+        help='do not cache compiled code in ~/.cache/tse.')
+    parser.add_argument(
+        '--startup-profile', action='store_true',
+        help='report time spent to start up to the standard error.')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='report lines matched and time spent by each statement to the '
+             'standard error.')
+    parser.add_argument(
+        '--profile', action='store', type=argstr, metavar='FILE',
+        help='profile actions with cProfile and write the result to FILE.')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='report number of files modified by --inplace.')
+    parser.add_argument(
+        '--server', action='store_true',
+        help='run as a server to execute requests of tsec command.')
+    parser.add_argument(
+        '--socket', action='store', type=argstr, metavar='PATH',
+        help='with --server, path of the socket. the default is $TSE_SOCKET, or '
+             '$XDG_RUNTIME_DIR/tse-UID/server.sock.')
+    parser.add_argument(
+        '--idle-timeout', action='store', type=float, default=600, metavar='SECONDS',
+        help='with --server, exit if no request is received for SECONDS '
+             '(default: 600). 0 means never.')
+    parser.add_argument(
+        '--workers', action='store', type=int, metavar='N',
+        help='with --server, number of requests executed at a time '
+             '(default: number of CPUs).')
     parser.add_argument('--input-encoding', '-ie', action='store', type=argstr,
                         help='encoding of input stream.')
     parser.add_argument(
@@ -449,28 +3419,114 @@ def getargparser():
     parser.add_argument('FILE', nargs="*", type=argstr,
                         help='With no FILE, or when FILE is -, read standard input.')
     parser.add_argument('--version', action='version',
-                        version='%(prog)s 0.1.0')
+                        version='%(prog)s ' + VERSION)
 
     return parser
 
 
-def main():
+def main(argv=None):
     parser = getargparser()
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    _startup('arguments')
+
+    if args.server:
+        if not hasattr(os, 'fork'):
+            parser.error("--server is not supported on this platform")
+        if args.statement or args.execute or args.FILE:
+            parser.error("--server cannot be used with --statement, --execute or FILE")
+        if args.workers is not None and args.workers < 1:
+            parser.error("--workers should be a positive number")
+        from tse import client
+        env = Env(None, None, None, None, args.input_encoding, args.output_encoding,
+                  args.module, args.module_star, args.script_file, None, False, None, None,
+                  cache=args.cache)
+        try:
+            serve(env, args.socket or client.socket_path(), args.idle_timeout, args.workers)
+        except RuntimeError as e:
+            parser.exit(1, '%s: %s\n' % (SHORTAPPNAME, e))
+        return
 
     if args.execute is not None:
         if args.statement:
             parser.error("--execute and --statement cannot be used together")
 
-    if args.inplace and not args.FILE:
+    if args.inplace and not args.FILE and not args.recursive:
         parser.error("--inplace may not be used with stdin")
 
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs should be a positive number")
+
+    if args.chunk_size is not None and not args.jobs:
+        parser.error("--chunk-size requires --jobs")
+
+    if len([o for o in (args.field_separator, args.field_format, args.widths) if o]) > 1:
+        parser.error("--field-separator, --csv, --tsv and --widths cannot be used together")
+
+    if args.field_format and args.bytes_mode:
+        parser.error("--%s cannot be used with --bytes" % args.field_format)
+
+    if args.max_count is not None and args.max_count < 1:
+        parser.error("--max-count should be a positive number")
+
+    if args.max_count_per_file is not None and args.max_count_per_file < 1:
+        parser.error("--max-count-per-file should be a positive number")
+
+    if args.max_count and args.jobs and args.jobs > 1:
+        parser.error("--max-count cannot be used with --jobs")
+
+    if args.batch is not None and args.batch < 1:
+        parser.error("--batch should be a positive number")
+
+    if args.batch and args.stats:
+        parser.error("--batch cannot be used with --stats")
+
+    if args.follow or args.state:
+        option = '--follow' if args.follow else '--state'
+        if not args.FILE and not args.recursive:
+            parser.error("%s may not be used with stdin" % option)
+        for name, value in (('--inplace', args.inplace), ('--jobs', args.jobs),
+                            ('--record-separator', args.record_separator)):
+            if value is not None:
+                parser.error("%s cannot be used with %s" % (option, name))
+
+    if args.follow and args.max_count_per_file:
+        parser.error("--follow cannot be used with --max-count-per-file")
+
+    if args.uniq and args.uniq_count:
+        parser.error("--uniq and --uniq-count cannot be used together")
+
+    if args.inplace and (args.sort_key is not None or args.uniq or args.uniq_count):
+        parser.error("--sort, --uniq and --uniq-count cannot be used with --inplace")
+
+    if args.command_jobs is not None and args.command_jobs < 1:
+        parser.error("--command-jobs should be a positive number")
+
     env = Env(
         args.execute, args.statement, args.begin, args.end, args.input_encoding, args.output_encoding,
         args.module, args.module_star, args.script_file, args.inplace, args.ignore_case,
-        args.field_separator, args.FILE)
+        args.field_separator, args.FILE, compile_loop=args.compile_loop,
+        jobs=args.jobs, unordered=args.unordered, chunk_size=args.chunk_size,
+        bytes_mode=args.bytes_mode, scan=args.scan, buffer_size=args.buffer_size,
+        line_buffered=args.line_buffered, verbose=args.verbose, cache=args.cache,
+        startup_profile=args.startup_profile, stats=args.stats, profile=args.profile,
+        command_jobs=args.command_jobs, command_timeout=args.command_timeout,
+        command_cache=args.command_cache, field_format=args.field_format, widths=args.widths,
+        record_separator=args.record_separator, max_count=args.max_count,
+        max_count_per_file=args.max_count_per_file, batch=args.batch,
+        recursive=args.recursive, include=args.include, exclude=args.exclude,
+        gitignore=args.gitignore, follow=args.follow, state=args.state,
+        sort_key=args.sort_key, uniq=args.uniq, uniq_count=args.uniq_count,
+        sort_memory=args.sort_memory)
+    _startup('compile')
+
+    try:
+        run(env)
+    except BrokenPipeError:
+        # Output of --end was not read.
+        _discard_output()
+
 
-    run(env)
+_startup('import')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,156 @@
+# -*- coding:utf-8 -*-
+"""Python API to process lines with tse statements.
+
+    >>> import tse
+    >>> proc = tse.compile([(r'(\\w+) (\\d+)', 'total[S1] = total.get(S1, 0) + int(S2)')],
+    ...                    begin='total = {}')
+    >>> proc.run(['a 1', 'b 2', 'a 3'])['total']
+    {'a': 4, 'b': 2}
+
+Statements are compiled once, and a Processor can be run repeatedly by
+multiple threads. Each run has its own namespace, and output of P() and
+print() is written to the output of the run instead of sys.stdout.
+
+tse.main is imported on the first call of compile(), so that tse.client
+starts quickly.
+"""
+
+import io
+import os
+import sys
+
+__all__ = ['compile', 'Processor']
+
+# Keyword arguments of Env which can be passed to compile().
+OPTIONS = frozenset([
+    'compile_loop', 'bytes_mode', 'field_format', 'widths', 'record_separator',
+    'max_count', 'max_count_per_file', 'batch', 'sort_key', 'uniq', 'uniq_count',
+    'sort_memory'])
+
+
+def _codes(codes):
+    if codes is None:
+        return None
+    if isinstance(codes, str):
+        codes = [codes]
+    return [list(codes)]
+
+
+def compile(statements=(), begin=None, end=None, field_separator=None, ignore_case=False,
+            module=None, module_star=None, script_file=None, input_encoding=None,
+            **options):
+    """Compile statements into a Processor.
+
+    ``statements`` is a list of ``(pattern, action)``. ``action``,
+    ``begin`` and ``end`` are a string or a list of strings, as the command
+    line. ``module`` and ``module_star`` are comma separated module names
+    to be imported. The script file is executed only if ``script_file``
+    is given. Other options are the same as the command line, e.g.
+    ``field_format='csv'`` for --csv and ``sort_key=''`` for --sort.
+    """
+    from tse import main
+
+    unknown = set(options) - OPTIONS
+    if unknown:
+        raise TypeError('unsupported option: %s' % ', '.join(sorted(unknown)))
+
+    statement = []
+    for pattern, actions in statements:
+        statement.append((main.StatementAction.ARGTYPE, [pattern] + _codes(actions)[0]))
+
+    env = main.Env(None, statement, _codes(begin), _codes(end), input_encoding, None,
+                   [module] if module else None, [module_star] if module_star else None,
+                   script_file, None, ignore_case, field_separator, None, **options)
+    env.scriptfile = script_file
+    return Processor(env)
+
+
+class Processor(object):
+    """Statements compiled by compile()."""
+
+    def __init__(self, env):
+        import threading
+        from tse import main
+        self._main = main
+        self.env = env
+        self._lock = threading.Lock()
+        self._namespace = None
+
+    def _new_namespace(self):
+        # Modules and the script file are loaded once, and the namespace is
+        # copied for each run.
+        main = self._main
+        with self._lock:
+            if self._namespace is None:
+                namespace = {}
+                main._init_namespace(self.env, namespace, namespace)
+                self._namespace = namespace
+        namespace = dict(self._namespace)
+        if '__tse_counter' in namespace:
+            namespace['__tse_counter'] = main.MatchCounter(
+                self.env.max_count, self.env.max_count_per_file)
+        return namespace
+
+    def _bind_output(self, namespace, output):
+        main = self._main
+        print_ = main.print_bytes if self.env.bytes_mode else print
+
+        def P(*args, **kwargs):
+            kwargs.setdefault('file', output)
+            print_(*args, **kwargs)
+        namespace['P'] = namespace['print'] = P
+
+    def _run_input(self, input, namespace):
+        env = self.env
+        if isinstance(input, (str, bytes, os.PathLike)):
+            filename = os.fspath(input)
+            with env.open_input(filename) as f:
+                self._main._run_script(env, f, filename, namespace, namespace)
+            return
+
+        filename = getattr(input, 'name', '<input>')
+        if env.record_separator is not None and hasattr(input, 'read'):
+            input = env.build_reader()(input)
+        self._main._run_script(env, input, filename, namespace, namespace)
+
+    def run(self, *inputs, output=None):
+        """Process inputs, and returns the namespace of the run.
+
+        An input is a path, a file object or an iterable of lines. Output
+        is written to ``output``, or the standard output if omitted.
+        """
+        env = self.env
+        if output is None:
+            output = sys.stdout
+
+        namespace = self._new_namespace()
+        self._bind_output(namespace, output)
+        if env.begincode:
+            exec(env.begincode, namespace)
+
+        sorter = env.open_sorter(output, namespace)
+        if sorter:
+            self._bind_output(namespace, sorter)
+        try:
+            for input in inputs:
+                try:
+                    self._run_input(input, namespace)
+                except self._main.Stop as e:
+                    if not e.file:
+                        break
+            if sorter:
+                sorter.finish()
+        finally:
+            if sorter:
+                sorter.close()
+
+        self._bind_output(namespace, output)
+        if env.endcode:
+            exec(env.endcode, namespace)
+        return namespace
+
+    def getoutput(self, *inputs):
+        """Process inputs, and returns the output as a string."""
+        output = io.StringIO()
+        self.run(*inputs, output=output)
+        return output.getvalue()